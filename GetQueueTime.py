@@ -1,38 +1,142 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.compute as pc
+import pyarrow.feather as feather
 import time
+import os
+import sys
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import argparse
 from tqdm import tqdm
-from helpers import (determine_job_type, check_shared_buyin)
+from helpers import (determine_job_type, check_shared_buyin, contains_any, gpu_request, write_waiting_times, read_waiting_times,
+                     remove_waiting_times,                     WAITING_TIMES_DIR, ALL_JOBS_DIR, FIRST_JOB_GAPS, gaps_metadata, stored_gaps,
+                     write_queue_depth, QUEUE_DEPTH_DIR, QUEUE_DEPTH_BIN_SECONDS, stage, start_run_log)
+import socket
 import datetime
+from zoneinfo import ZoneInfo
 
+ACCOUNTING_FILE = '/projectnb/rcsmetrics/accounting/data/scc/{year}.feather'
+OUTPUT_FILE = '/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_per_job_type.csv'
+# Output formats: year=/month= partitioned Parquet under WAITING_TIMES_DIR, or the per-year CSV
+OUTPUT_FORMATS = ['parquet', 'csv']
+# Per-year (owner, job_type) latest end times and ux_end_time watermark for incremental runs
+STATE_FILE = '/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_state.feather'
+# The same for the all-jobs mode (--all-jobs), which keeps its own output and state
+ALL_JOBS_OUTPUT_FILE = '/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_all_jobs.csv'
+ALL_JOBS_STATE_FILE = '/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_all_jobs_state.feather'
+# Columns of the yearly accounting file used by the ETL
+ACCOUNTING_COLUMNS = ['ux_submission_time', 'ux_start_time', 'ux_end_time', 'granted_pe', 'slots', 'options', 'pe_taskid', 'qname', 'job_number', 'owner', 'job_name', 'task_number']
+# What the sweep-line events read, besides the columns they are swept by (qname, owner)
+SWEEP_COLUMNS = ['ux_submission_time', 'ux_start_time', 'ux_end_time', 'granted_pe', 'slots', 'pe_taskid']
+# Columns of waiting_times_{year}_per_job_type.csv
+OUTPUT_COLUMNS = ['job_type', 'class_user', 'class_own', 'first_job_waiting_time', 'month', 'year', 'day', 'job_number', 'slots', 'hour', 'weekday',
+                  'gpus', 'gpu_c', 'gpu_memory_gb', 'tasks', 'pending_jobs', 'pending_slots',
+                  'first_job_gaps', 'owner_running_jobs', 'owner_running_slots']
+# The all-jobs mode adds whether each job is a first job
+ALL_JOBS_COLUMNS = OUTPUT_COLUMNS + ['first_job']
+# GPU request fields parsed from 'options', carried through to the output records
+GPU_COLUMNS = ['gpus', 'gpu_c', 'gpu_memory_gb']
+# Backlog of the job's queue when it was submitted, from the queue-depth sweep
+QUEUE_BACKLOG_COLUMNS = ['pending_jobs', 'pending_slots']
+# What the owner already had running when the job was submitted
+OWNER_USAGE_COLUMNS = ['owner_running_jobs', 'owner_running_slots']
+# Submission-context columns by the column their sweep runs over. Both are optional (--queue-backlog,
+# --owner-usage): their sweeps read the whole year's file, also in --stream and --incremental runs.
+SUBMISSION_CONTEXT_COLUMNS = {'qname': QUEUE_BACKLOG_COLUMNS, 'owner': OWNER_USAGE_COLUMNS}
+# Calendar fields are taken in the cluster's timezone, not the timezone of the host running the ETL
+CLUSTER_TIMEZONE = 'America/New_York'
+MONTH_ABBR = np.array(["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                       "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"])
+ENGINES = ['vectorized', 'loop']
+# Rows per Arrow record batch in streaming mode
+STREAM_BATCH_ROWS = 1_000_000
+# Columns the first-job engine reads, the ones copied to the workers of an owner-sharded run
+FIRST_JOB_INPUT_COLUMNS = ['ux_submission_time', 'ux_start_time', 'ux_end_time', 'owner', 'job_type', 'qname', 'options',
+                           'class_user', 'class_own', 'job_number', 'slots', 'tasks'] + GPU_COLUMNS + QUEUE_BACKLOG_COLUMNS + OWNER_USAGE_COLUMNS
+# Accounting writes are only nearly ordered by end time, so incremental runs save the first-job state as of
+# this many seconds before the watermark (the settled point) and decide the records ending after it again
+WATERMARK_SLACK = 3600
 
-def waiting_time_per_job_type(input_file_name, output_file_name, year):
-    # Read data from the Feather file
-    df = pd.read_feather(input_file_name)
 
-    # filter cols we need
-    df = df[['ux_submission_time', 'ux_start_time', 'ux_end_time', 'granted_pe', 'slots', 'options', 'pe_taskid', 'qname', 'job_number', 'owner', 'job_name', 'task_number']]
-    # remove records: 'mpi' exist in granted_pe and its pe_taskid column has a valid value
-    df = df[~((df['granted_pe'].str.contains('mpi', na=False)) & (df['pe_taskid'].notna() & df['pe_taskid'].ne('None')))]
-    
-    # df['job_type'] = df.apply(determine_job_type, axis=1)
-    print('Total jobs:', len(df))
-    df = determine_job_type(df)
-    print('after determined job type:', len(df))
-    print(pd.crosstab(index=df.job_type, columns="count"))
-    df = check_shared_buyin(df)
-    df.sort_values(by='ux_end_time', inplace=True)
-    print('after sorting by ending_time:', pd.crosstab(index=df.job_type, columns="count"))
+def mpi_slave_records(df):
+    # 'mpi' exist in granted_pe and its pe_taskid column has a valid value
+    return (df['granted_pe'].str.contains('mpi', na=False)) & (df['pe_taskid'].notna() & df['pe_taskid'].ne('None'))
+
 
+def classify_jobs(df):
+    with stage('mpi_slave_filter', len(df)) as record:
+        # filter cols we need
+        df = df[ACCOUNTING_COLUMNS]
+        # remove records of MPI slave tasks
+        df = df[~mpi_slave_records(df)]
+        record['rows_out'] = len(df)
+        # every accounting record is one task; collapse_array_jobs sums them per array job
+        df['tasks'] = 1
+    with stage('classify', len(df)):
+        df = determine_job_type(df)
+    with stage('gpu_request', len(df)):
+        df[GPU_COLUMNS] = gpu_request(df['options'])
+    with stage('queue_join', len(df)):
+        df = check_shared_buyin(df)
+    return df
+
+
+def cast_times(df, year):
     # Ensure the time columns are integers
     df['ux_submission_time'] = df['ux_submission_time'].astype(int)
     df['ux_start_time'] = df['ux_start_time'].astype(int)
     df['ux_end_time'] = df['ux_end_time'].astype(int)
     df['year'] = year
+    return df
+
+
+def collapse_array_jobs(df):
+    # Array tasks of one job (same owner, job number, submission time and job type) become one
+    # logical job: earliest start of the tasks that started, latest end, and the task count in
+    # 'tasks'. The other columns come from the job's first task; non-array records pass through.
+    array_task = df['task_number'].fillna(0).to_numpy() > 0
+    tasks = df[array_task]
+    if tasks.empty:
+        return df
+    group = tasks.groupby(['owner', 'job_number', 'ux_submission_time', 'job_type'], sort=False, dropna=False).ngroup().to_numpy()
+    _, first_task = np.unique(group, return_index=True)
+    start = tasks['ux_start_time'].where(tasks['ux_start_time'] > 0)
+    jobs = tasks.iloc[first_task].copy()
+    jobs['ux_start_time'] = start.groupby(group).min().fillna(0).to_numpy()
+    jobs['ux_end_time'] = tasks['ux_end_time'].groupby(group).max().to_numpy()
+    jobs['tasks'] = tasks['tasks'].groupby(group).sum().to_numpy()
+    return pd.concat([df[~array_task], jobs])
 
-    
+
+def prepare_jobs(df, year, collapse_arrays=False, events=None):
+    print('Total jobs:', len(df))
+    df = classify_jobs(df)
+    print('after determined job type:', len(df))
+    if events is not None:
+        df = add_submission_context(df, events)
+    if collapse_arrays:
+        with stage('collapse_arrays', len(df)) as record:
+            df = collapse_array_jobs(df)
+            record['rows_out'] = len(df)
+        print('after collapsing array jobs:', len(df))
+    print(pd.crosstab(index=df.job_type, columns="count"))
+    with stage('sort', len(df)):
+        df.sort_values(by='ux_end_time', kind='stable', inplace=True)
+    print('after sorting by ending_time:', pd.crosstab(index=df.job_type, columns="count"))
+    return cast_times(df, year)
+
+
+def first_jobs_loop(df, year, timezone=CLUSTER_TIMEZONE, carried_end_times=None, gaps=FIRST_JOB_GAPS):
+    # Row-by-row reference engine, kept to diff the vectorized engine against
+    cluster_tz = ZoneInfo(timezone)
     latest_end_times = {} # Initialize a dictionary to track the latest end time for each (owner, job_type)
+    if carried_end_times is not None:
+        latest_end_times.update(carried_end_times.items())
     job_type_waiting_times = [] # Initialize a list to store waiting times
 
     for index, row in tqdm(df.iterrows(), total=len(df), desc="Processing jobs"):
@@ -42,19 +146,20 @@ def waiting_time_per_job_type(input_file_name, output_file_name, year):
         owner = row['owner']
         job_type = row['job_type']
         qname = row['qname']
-        initialYear = datetime.datetime.fromtimestamp(submission_time).year
+        submitted = datetime.datetime.fromtimestamp(submission_time, tz=cluster_tz)
 
-        # Only process jobs from the specified year
-        if initialYear == year:
-            month = datetime.datetime.fromtimestamp(submission_time).strftime('%b')
-            day = datetime.datetime.fromtimestamp(submission_time).day  # Extract 1–31
+        # Initialize the latest end time for this (owner, job_type) if not already set
+        if (owner, job_type) not in latest_end_times:
+            latest_end_times[(owner, job_type)] = 0
 
-            # Initialize the latest end time for this (owner, job_type) if not already set
-            if (owner, job_type) not in latest_end_times:
-                latest_end_times[(owner, job_type)] = 0
+        # Only process jobs from the specified year
+        if submitted.year == year:
+            month = MONTH_ABBR[submitted.month - 1]
+            day = submitted.day  # Extract 1–31
 
             # Check if this job is a "first job" (submission_time > latest_end_time)
             if submission_time > latest_end_times[(owner, job_type)]:
+                idle_gap = submission_time - latest_end_times[(owner, job_type)]
                 current_waiting_time = start_time - submission_time
                 if current_waiting_time >= 0:
                     # Determine job_type_label based on job_type and qname
@@ -78,37 +183,838 @@ def waiting_time_per_job_type(input_file_name, output_file_name, year):
                         year,
                         day,
                         row['job_number'],
-                        row['slots']
+                        row['slots'],
+                        submitted.hour,
+                        submitted.weekday(),
+                        row['gpus'],
+                        row['gpu_c'],
+                        row['gpu_memory_gb'],
+                        row['tasks'],
+                        row.get('pending_jobs'),
+                        row.get('pending_slots'),
+                        sum(1 << i for i, gap in enumerate(gaps) if idle_gap > gap),
+                        row.get('owner_running_jobs'),
+                        row.get('owner_running_slots')
                     ])
 
-            # Update the latest end time for this (owner, job_type)
-            latest_end_times[(owner, job_type)] = max(end_time, latest_end_times[(owner, job_type)])
+        # Update the latest end time for this (owner, job_type), also from jobs submitted in another
+        # year (e.g. still running on Jan 1): they are not reported, but they do precede later jobs
+        latest_end_times[(owner, job_type)] = max(end_time, latest_end_times[(owner, job_type)])
 
     # Convert the results to a DataFrame
-    job_type_waiting_df = pd.DataFrame(job_type_waiting_times, columns=['job_type', 'class_user', 'class_own', 'first_job_waiting_time', 'month', 'year', 'day', 'job_number', 'slots'])
+    return pd.DataFrame(job_type_waiting_times, columns=OUTPUT_COLUMNS)[output_columns(context=submission_context(df))]
+
+
+def job_type_labels(df):
+    # Same labels as the loop engine: "GPU = 1 <qname>", "GPU > 1 <qname>", "MPI job <qname>", "<job_type> <qname>".
+    # Each label is built once per distinct (prefix, qname) pair and broadcast through the codes.
+    job_types = df['job_type'].astype('category')
+    qnames = df['qname'].astype('category')
+    # The last entry of each is for a missing value (code -1), spelled as the loop engine's f-string would
+    prefixes = ['GPU = 1', 'GPU > 1', 'MPI job'] + [f'{t}' for t in job_types.cat.categories] + [f'{np.nan}']
+    qname_labels = [f'{q}' for q in qnames.cat.categories] + [f'{np.nan}']
+
+    is_gpu = job_types.eq('GPU').to_numpy()
+    single_gpu = contains_any(df['options'], ['gpus=1']) >= 0
+    prefix = np.select(
+        [is_gpu & single_gpu, is_gpu, job_types.eq('MPI').to_numpy()],
+        [0, 1, 2],
+        default=job_types.cat.codes.to_numpy().astype(np.int64) % (len(prefixes) - 3) + 3,
+    )
+    pair = prefix * len(qname_labels) + qnames.cat.codes.to_numpy().astype(np.int64) % len(qname_labels)
+    codes, pairs = pd.factorize(pair)
+    labels = np.array([f'{prefixes[p // len(qname_labels)]} {qname_labels[p % len(qname_labels)]}' for p in pairs], dtype=object)
+    return pd.Series(labels[codes], index=df.index, dtype=object)
+
+
+def submission_calendar(submission_time, timezone=CLUSTER_TIMEZONE):
+    # year, month abbreviation, day, hour and weekday (Mon=0) of every submission time in one conversion
+    submitted = pd.to_datetime(submission_time, unit='s', utc=True).dt.tz_convert(timezone).dt
+    return pd.DataFrame({
+        'year': submitted.year,
+        'month': MONTH_ABBR[submitted.month.to_numpy() - 1],
+        'day': submitted.day,
+        'hour': submitted.hour,
+        'weekday': submitted.weekday,
+    }, index=submission_time.index)
+
+
+def seed_end_times(df, latest_end_times):
+    # Latest end time carried in from earlier records for each row's (owner, job_type), 0 if none
+    if latest_end_times is None or latest_end_times.empty:
+        return np.zeros(len(df), dtype=np.int64)
+    keys = pd.MultiIndex.from_arrays([df['owner'], df['job_type']])
+    return latest_end_times.reindex(keys).fillna(0).to_numpy(dtype=np.int64)
+
+
+def update_end_times(df, latest_end_times):
+    # Fold the end times of df into the (owner, job_type) -> latest end time state
+    batch_end_times = df.groupby(['owner', 'job_type'], dropna=False)['ux_end_time'].max()
+    if latest_end_times is None or latest_end_times.empty:
+        return batch_end_times
+    return pd.concat([latest_end_times, batch_end_times]).groupby(level=[0, 1], dropna=False).max()
+
+
+def gap_bits(idle_gap, gaps=FIRST_JOB_GAPS):
+    # Bit i is set when the idle gap is longer than gaps[i] seconds: a first job under the
+    # stricter definition "submitted more than gaps[i] after the previous job ended"
+    bits = np.zeros(len(idle_gap), dtype=np.uint8)
+    for i, gap in enumerate(gaps):
+        bits |= (idle_gap > gap).astype(np.uint8) << i
+    return bits
+
+
+def previous_end_times(group, end):
+    # Running max of end within each group, shifted by one row: the latest end time seen
+    # before each row of its group (0 for the first). Rows keep their order within a group.
+    latest_end = pd.Series(end).groupby(group).cummax()
+    return latest_end.groupby(group).shift(1, fill_value=0).to_numpy(dtype=np.int64)
+
+
+def first_jobs_vectorized(df, year, latest_end_times=None, timezone=CLUSTER_TIMEZONE, gaps=FIRST_JOB_GAPS, all_jobs=False, pool=None):
+    # Columnar engine: df is already sorted by ux_end_time, so a grouped running
+    # max of ux_end_time, shifted by one row, is the latest end time the loop
+    # engine would have seen for that (owner, job_type) before the current job.
+    # latest_end_times optionally seeds that state from records processed earlier
+    # (a Series indexed by (owner, job_type)); the updated state is returned.
+    # The idle gap since that end time also gives the first_job_gaps bitmask (see gap_bits).
+    # With all_jobs every job with a wait is kept, and 'first_job' marks the first jobs.
+    # With a process pool the owners are split into one shard per worker (see sharded_first_jobs).
+    if pool is not None and len(df):
+        result, latest_end_times = sharded_first_jobs(df, year, latest_end_times, timezone, gaps, all_jobs, pool)
+    else:
+        result, latest_end_times = decide_first_jobs(df, year, latest_end_times, timezone, gaps, all_jobs)
+    return result.reset_index(drop=True), latest_end_times
+
+
+def decide_first_jobs(df, year, latest_end_times=None, timezone=CLUSTER_TIMEZONE, gaps=FIRST_JOB_GAPS, all_jobs=False):
+    # first_jobs_vectorized in this process; the rows keep the index of df
+    calendar = submission_calendar(df['ux_submission_time'], timezone)
+
+    # Every job updates the state, in end order, including jobs submitted in another year (e.g. still
+    # running on Jan 1); only the jobs from the specified year are reported
+    in_year = (calendar['year'] == year).to_numpy()
+
+    group = df.groupby(['owner', 'job_type'], sort=False, dropna=False).ngroup().to_numpy(dtype=np.int64)
+    end = df['ux_end_time'].to_numpy(dtype=np.int64)
+    previous_end = np.maximum(previous_end_times(group, end), seed_end_times(df, latest_end_times))
+
+    waiting_time = df['ux_start_time'] - df['ux_submission_time']
+    idle_gap = df['ux_submission_time'].to_numpy(dtype=np.int64) - previous_end
+    first = (idle_gap > 0) & (waiting_time >= 0) & in_year
+    latest_end_times = update_end_times(df, latest_end_times)
+    keep = (waiting_time >= 0) & in_year if all_jobs else first
+    df = df[keep]
+    calendar = calendar[keep]
+
+    return pd.DataFrame({
+        'job_type': job_type_labels(df),
+        'class_user': df['class_user'],
+        'class_own': df['class_own'],
+        'first_job_waiting_time': waiting_time[keep],
+        'month': calendar['month'],
+        'year': year,
+        'day': calendar['day'],
+        'job_number': df['job_number'],
+        'slots': df['slots'],
+        'hour': calendar['hour'],
+        'weekday': calendar['weekday'],
+        'gpus': df['gpus'],
+        'gpu_c': df['gpu_c'],
+        'gpu_memory_gb': df['gpu_memory_gb'],
+        'tasks': df['tasks'],
+        'pending_jobs': df.get('pending_jobs'),
+        'pending_slots': df.get('pending_slots'),
+        'first_job_gaps': gap_bits(np.maximum(idle_gap[keep.to_numpy()], 0), gaps),
+        'owner_running_jobs': df.get('owner_running_jobs'),
+        'owner_running_slots': df.get('owner_running_slots'),
+        'first_job': first[keep],
+    }, columns=output_columns(all_jobs, submission_context(df))), latest_end_times
+
+
+def owner_shards(owner, workers):
+    # Shard number of every row: a stable hash of its owner, so an owner's jobs never span shards
+    codes, owners = pd.factorize(owner)
+    shard_of_owner = pd.util.hash_array(np.asarray(owners, dtype=object)) % workers
+    return np.append(shard_of_owner, 0)[codes].astype(np.int64)  # a missing owner (code -1) goes to shard 0
+
+
+def share_frame(df):
+    # Copy df (without its index) into a new shared-memory block as an Arrow IPC stream
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    size = pa.MockOutputStream()
+    with pa.ipc.new_stream(size, table.schema) as writer:
+        writer.write_table(table)
+    block = shared_memory.SharedMemory(create=True, size=max(size.size(), 1))
+    with pa.ipc.new_stream(pa.FixedSizeBufferWriter(pa.py_buffer(block.buf)), table.schema) as writer:
+        writer.write_table(table)
+    return block
+
+
+def read_shared_frame(block):
+    # The DataFrame written by share_frame, copied out so the block can be closed
+    with pa.ipc.open_stream(block.buf) as reader:
+        return reader.read_all().to_pandas().copy()
+
+
+def _first_jobs_shard(name, year, latest_end_times, timezone, gaps, all_jobs):
+    # Worker: decide the rows of one owner shard, read from shared memory. The result goes back as an
+    # Arrow IPC buffer indexed by row within the shard, so no DataFrame is pickled either way.
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        df = read_shared_frame(block)
+    finally:
+        block.close()
+    result, latest_end_times = decide_first_jobs(df, year, latest_end_times, timezone, gaps, all_jobs)
+    table = pa.Table.from_pandas(result, preserve_index=True)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue(), latest_end_times
+
+
+def sharded_first_jobs(df, year, latest_end_times, timezone, gaps, all_jobs, pool):
+    # First-job state only depends on (owner, job_type), so each owner shard runs the whole engine
+    # (calendar, labels, running max, gap bits and state) in a worker of pool (an OwnerPool), from a
+    # copy of its rows in shared memory. The shards' rows are put back in the order of df, so the
+    # result is the same as first_jobs_vectorized in one process.
+    shards = owner_shards(df['owner'], pool.workers)
+    rows = [np.flatnonzero(shards == shard) for shard in range(pool.workers)]
+    engine_input = df[[column for column in FIRST_JOB_INPUT_COLUMNS if column in df.columns]]
+    blocks = []
+    try:
+        for shard_rows in rows:
+            blocks.append(share_frame(engine_input.iloc[shard_rows]))
+        futures = [pool.submit(_first_jobs_shard, block.name, year, latest_end_times, timezone, gaps, all_jobs) for block in blocks]
+        results = []
+        positions = []
+        states = []
+        for shard_rows, future in zip(rows, futures):
+            buffer, shard_end_times = future.result()
+            with pa.ipc.open_stream(buffer) as reader:
+                result = reader.read_all().to_pandas()
+            results.append(result)
+            positions.append(shard_rows[result.index.to_numpy()])
+            states.append(shard_end_times)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    positions = np.concatenate(positions)
+    order = np.argsort(positions, kind='stable')
+    result = pd.concat(results).iloc[order].set_axis(df.index[positions[order]])
+    return result, pd.concat(states).groupby(level=[0, 1], dropna=False).max()
+
+
+class OwnerPool(ProcessPoolExecutor):
+    # Process pool for sharded_first_jobs: one owner shard per worker
+    def __init__(self, workers):
+        super().__init__(max_workers=workers)
+        self.workers = workers
+
+
+def owner_pool(workers):
+    # An OwnerPool, or a null context giving no pool for a single worker
+    return OwnerPool(workers) if workers > 1 else contextlib.nullcontext()
+
+
+def output_columns(all_jobs=False, context=tuple(SUBMISSION_CONTEXT_COLUMNS)):
+    # Columns of the mode's output, with the submission-context columns of the sweeps in context only
+    columns = ALL_JOBS_COLUMNS if all_jobs else OUTPUT_COLUMNS
+    skipped = [column for by, by_columns in SUBMISSION_CONTEXT_COLUMNS.items() if by not in context for column in by_columns]
+    return [column for column in columns if column not in skipped]
+
+
+def iter_accounting_batches(input_file_name, batch_rows=STREAM_BATCH_ROWS):
+    # Memory-mapped read of only the columns we need, one record batch at a time
+    dataset = ds.dataset(input_file_name, format='feather')
+    batches = iter(dataset.to_batches(columns=ACCOUNTING_COLUMNS, batch_size=batch_rows))
+    while True:
+        with stage('read') as record:
+            batch = next(batches, None)
+            df = batch.to_pandas() if batch is not None else None
+            record['rows_out'] = len(df) if df is not None else 0
+        if df is None:
+            return
+        if len(df):
+            yield df
+
+
+def year_start(year, timezone=CLUSTER_TIMEZONE):
+    # Unix time of Jan 1 00:00 of year in the cluster timezone
+    return int(pd.Timestamp(year=year, month=1, day=1, tz=timezone).timestamp())
+
+
+def read_ending_after(input_file_name, boundary, columns=ACCOUNTING_COLUMNS):
+    # The records of an accounting Feather file with ux_end_time >= boundary. Only ux_end_time is decoded
+    # for every record batch; the other columns only for the batches that have such records, which in a
+    # file kept in completion order are the last few.
+    with pa.memory_map(input_file_name) as source:
+        schema = pa.ipc.open_file(source).schema
+        ends = pa.ipc.open_file(source, options=pa.ipc.IpcReadOptions(included_fields=[schema.get_field_index('ux_end_time')]))
+        rows = pa.ipc.open_file(source, options=pa.ipc.IpcReadOptions(
+            included_fields=[schema.get_field_index(column) for column in columns]))
+        batches = []
+        for i in range(ends.num_record_batches):
+            matches = pc.indices_nonzero(pc.greater_equal(ends.get_batch(i).column(0), boundary))
+            if len(matches):
+                batches.append(rows.get_batch(i).take(matches))
+        return pa.Table.from_batches(batches, schema=rows.schema).select(columns).to_pandas()
+
+
+def carry_over_end_times(previous_input_file_name, year, timezone=CLUSTER_TIMEZONE):
+    # (owner, job_type) -> latest end time of the jobs in the previous year's file still running when the
+    # year starts. Files are kept in completion order, so most such jobs are in the year's own file (and
+    # update the state there); this covers the ones recorded in the previous file. Only the rows whose
+    # ux_end_time crosses the boundary are read (see read_ending_after), so any year can be processed on its own.
+    boundary = year_start(year, timezone)
+    with stage('carry_over_read') as record:
+        tail = read_ending_after(previous_input_file_name, boundary)
+        record['rows_out'] = len(tail)
+    tail = classify_jobs(tail)
+    tail = cast_times(tail, year - 1)
+    print(f'Carried over from {previous_input_file_name}:', len(tail), 'jobs running at the start of', year)
+    return update_end_times(tail, None)
+
+
+def queue_events(df, by='qname'):
+    # Sweep-line state of every queue (or of every value of another column, e.g. owner): the
+    # submission, start and end of each job are events, sorted by (by, time) in one O(n log n) sort;
+    # after each event, the pending jobs and slots, running jobs and running slots of its queue.
+    # A job that never started (ux_start_time 0) stays pending until it leaves at its end time.
+    # Every job adds as much as it removes within its own queue, so a plain cumulative sum over
+    # the sorted events is the per-queue running total.
+    submission = df['ux_submission_time'].to_numpy(dtype=np.int64)
+    started = df['ux_start_time'].to_numpy(dtype=np.int64) > 0
+    start = np.maximum(df['ux_start_time'].to_numpy(dtype=np.int64), submission)
+    end = np.maximum(df['ux_end_time'].to_numpy(dtype=np.int64), start)
+    values = df[by].astype('category')
+    codes = values.cat.codes.to_numpy()
+
+    ones = np.ones(len(df), dtype=np.int32)
+    running = started.astype(np.int32)
+    requested = df['slots'].to_numpy(dtype=np.int32)
+    slots = requested * running
+    queue = np.concatenate([codes, codes, codes])
+    time = np.concatenate([submission, np.where(started, start, end), end])
+    order = np.lexsort((time, queue))
+    return pd.DataFrame({
+        by: pd.Categorical.from_codes(queue[order], dtype=values.dtype),
+        'time': time[order],
+        'pending': np.concatenate([ones, -ones, 0 * ones])[order].cumsum(dtype=np.int32),
+        'pending_slots': np.concatenate([requested, -requested, 0 * requested])[order].cumsum(dtype=np.int32),
+        'running': np.concatenate([0 * ones, running, -running])[order].cumsum(dtype=np.int32),
+        'running_slots': np.concatenate([0 * slots, slots, -slots])[order].cumsum(dtype=np.int32),
+    })
+
+
+QUEUE_STATE_COLUMNS = ['pending', 'pending_slots', 'running', 'running_slots']
 
-    # Save the results to a CSV file
-    job_type_waiting_df.to_csv(output_file_name, index=False, chunksize=100000)
-    
+
+def queue_state_asof(events, queue, time, inclusive=True, by='qname'):
+    # Merge-as-of of (queue code, time) queries against the sorted events: the state of each
+    # queue after its last event at or before time (strictly before with inclusive=False), zero
+    # if it has none. Both sides are one sortable (queue, time) key, so this is one searchsorted.
+    codes = events[by].cat.codes.to_numpy().astype(np.int64)
+    key = codes * 2**33 + events['time'].to_numpy()  # times stay far below 2**33
+    queue = np.asarray(queue, dtype=np.int64)
+    last = np.searchsorted(key, queue * 2**33 + time, side='right' if inclusive else 'left') - 1
+    found = (queue >= 0) & (last >= 0) & (codes[np.maximum(last, 0)] == queue)
+    return {column: np.where(found, events[column].to_numpy()[np.maximum(last, 0)], 0) for column in QUEUE_STATE_COLUMNS}
+
+
+def queue_depth_series(events, year, timezone=CLUSTER_TIMEZONE, bin_seconds=QUEUE_DEPTH_BIN_SECONDS):
+    # Snapshot of every queue's state at each bin_seconds boundary of the year; rows of an idle
+    # queue (all zero) are left out.
+    edges = np.arange(year_start(year, timezone), year_start(year + 1, timezone), bin_seconds, dtype=np.int64)
+    codes = events['qname'].cat.codes.to_numpy()
+    queues = np.unique(codes[codes >= 0])
+    series = pd.DataFrame({
+        'qname': pd.Categorical.from_codes(np.repeat(queues, len(edges)), dtype=events['qname'].dtype),
+        'time': pd.to_datetime(np.tile(edges, len(queues)), unit='s', utc=True),
+        **queue_state_asof(events, np.repeat(queues, len(edges)), np.tile(edges, len(queues))),
+    })
+    busy = series[QUEUE_STATE_COLUMNS].to_numpy().any(axis=1)
+    return series[busy].reset_index(drop=True)
+
+
+def read_sweep_events(input_file_name, by=('qname',)):
+    # Sweep events of a whole accounting file by each column of by, read with only the columns they need
+    df = pd.read_feather(input_file_name, columns=SWEEP_COLUMNS + list(by))
+    df = df[~mpi_slave_records(df)]
+    return {column: queue_events(df, column) for column in by}
+
+
+def context_sweeps(queue_backlog=False, owner_usage=False):
+    # Columns swept for the submission context of a run
+    return ('qname',) * queue_backlog + ('owner',) * owner_usage
+
+
+def submission_context(df):
+    # The sweeps whose submission-context columns df carries
+    return tuple(by for by, columns in SUBMISSION_CONTEXT_COLUMNS.items() if columns[0] in df.columns)
+
+
+def submission_events(input_file_name, context):
+    # The events of each sweep in context (e.g. per queue and per owner) the jobs' submission context is looked up in
+    with stage('sweep_events') as record:
+        events = read_sweep_events(input_file_name, by=context)
+        record['rows_out'] = sum(len(column_events) for column_events in events.values())
+    return events
+
+
+def state_at_submission(df, events, by):
+    # State of each job's own queue (by='qname') or owner (by='owner') just before its submission
+    values = df[by].astype('category')
+    codes = np.append(events[by].cat.categories.get_indexer(values.cat.categories), -1)[values.cat.codes.to_numpy()]
+    return queue_state_asof(events, codes, df['ux_submission_time'].to_numpy(dtype=np.int64), inclusive=False, by=by)
+
+
+def add_queue_backlog(df, events):
+    # Pending jobs and slots in each job's qname just before its submission: the jobs submitted
+    # earlier that had not started yet (only jobs that have finished are in the accounting file)
+    state = state_at_submission(df, events, 'qname')
+    df['pending_jobs'] = state['pending']
+    df['pending_slots'] = state['pending_slots']
+    return df
+
+
+def add_owner_usage(df, events):
+    # Jobs and slots the job's owner had running, in any queue, just before its submission. The
+    # per-owner events are that owner's run intervals (start, end) in sorted order, so this is the
+    # same as-of lookup as the queue backlog.
+    state = state_at_submission(df, events, 'owner')
+    df['owner_running_jobs'] = state['running']
+    df['owner_running_slots'] = state['running_slots']
+    return df
+
+
+def add_submission_context(df, events):
+    # events from submission_events()
+    if 'qname' in events:
+        with stage('queue_backlog', len(df)):
+            df = add_queue_backlog(df, events['qname'])
+    if 'owner' in events:
+        with stage('owner_usage', len(df)):
+            df = add_owner_usage(df, events['owner'])
+    return df
+
+
+def queue_depth_per_year(input_file_name, output_dir, year, timezone=CLUSTER_TIMEZONE):
+    # ETL stage: the year's per-queue pending/running series, written to output_dir
+    with stage('queue_events') as record:
+        events = read_sweep_events(input_file_name)['qname']
+        record['rows_out'] = len(events)
+    with stage('queue_depth_sweep', len(events)) as record:
+        series = queue_depth_series(events, year, timezone)
+        record['rows_out'] = len(series)
+    with stage('queue_depth_write', len(series)):
+        write_queue_depth(series, output_dir, year)
+    print(f'Queue depth of {year} ({len(series)} queue-{QUEUE_DEPTH_BIN_SECONDS}s rows) saved to {output_dir}')
+    return series
+
+
+def stream_first_jobs(input_file_name, year, batch_rows=STREAM_BATCH_ROWS, timezone=CLUSTER_TIMEZONE, carried_end_times=None,
+                      events=None, gaps=FIRST_JOB_GAPS, all_jobs=False, pool=None):
+    # Streaming engine: memory is bounded by two record batches plus the
+    # (owner, job_type) state (and the whole year's events, when given). Accounting records are appended as jobs finish,
+    # so the file is (nearly) ordered by ux_end_time. Rows of the current batch
+    # are held back until the next batch shows nothing can end before them; a
+    # record ending before rows that were already decided is out of order and
+    # would change the result, so we refuse rather than guess.
+    latest_end_times = carried_end_times
+    pending = None
+    watermark = -np.inf
+    total_jobs = 0
+
+    def decide(ready):
+        nonlocal latest_end_times, watermark
+        with stage('sort', len(ready)):
+            ready = cast_times(ready.sort_values(by='ux_end_time', kind='stable'), year)
+        with stage('first_jobs', len(ready)) as record:
+            result, latest_end_times = first_jobs_vectorized(ready, year, latest_end_times, timezone, gaps, all_jobs, pool)
+            record['rows_out'] = len(result)
+        watermark = ready['ux_end_time'].max()
+        return result
+
+    for batch in iter_accounting_batches(input_file_name, batch_rows):
+        total_jobs += len(batch)
+        batch = classify_jobs(batch)
+        if batch.empty:
+            continue
+        if events is not None:
+            batch = add_submission_context(batch, events)
+        cutoff = batch['ux_end_time'].min()
+        if cutoff < watermark:
+            raise ValueError(f'{input_file_name} is not ordered by ux_end_time '
+                             f'(record ending at {cutoff:.0f} after {watermark:.0f}); '
+                             'rerun without --stream')
+        if pending is None:
+            pending = batch
+            continue
+        ready = pending['ux_end_time'] < cutoff
+        if ready.any():
+            yield decide(pending[ready])
+        pending = pd.concat([pending[~ready], batch])
+
+    if pending is not None:
+        yield decide(pending)
+    print('Total jobs:', total_jobs)
+
+
+def read_state(state_file_name):
+    # State saved by an earlier incremental run: year, settled point, watermark, token and csv offset of the
+    # provisional rows it wrote, the submission-context sweeps and first_job_gaps thresholds of the output,
+    # and latest_end_times as of the settled point
+    table = feather.read_table(state_file_name)
+    metadata = table.schema.metadata
+    if b'settled' not in metadata:
+        raise ValueError(f'{state_file_name} was written by an earlier version without a settled point; rebuild the year')
+    return {
+        'year': int(metadata[b'year']),
+        'settled': int(metadata[b'settled']),
+        'watermark': int(metadata[b'watermark']),
+        'token': int(metadata[b'token']),
+        'offset': int(metadata[b'offset']),
+        'context': tuple(by for by in metadata.get(b'context', b'').decode().split(',') if by),
+        'gaps': stored_gaps(metadata),
+        'latest_end_times': table.to_pandas().set_index(['owner', 'job_type'])['latest_end_time'],
+    }
+
+
+def write_state(state_file_name, year, settled, watermark, latest_end_times, token, offset=0, context=(), gaps=FIRST_JOB_GAPS):
+    # One row per (owner, job_type); year, settled, watermark, token, offset, context and gaps go in the schema metadata.
+    # Written to a temporary file first so an interrupted run never leaves a torn state.
+    table = pa.Table.from_pandas(latest_end_times.rename('latest_end_time').reset_index(), preserve_index=False)
+    table = table.replace_schema_metadata({'year': str(year), 'settled': str(settled), 'watermark': str(watermark),
+                                           'token': str(token), 'offset': str(offset), 'context': ','.join(context),
+                                           **gaps_metadata(gaps)})
+    temp_file_name = f'{state_file_name}.tmp'
+    feather.write_feather(table, temp_file_name, compression='zstd')
+    os.replace(temp_file_name, state_file_name)
+
+
+def decide_settled(df, year, latest_end_times, settled, timezone=CLUSTER_TIMEZONE, gaps=FIRST_JOB_GAPS, all_jobs=False, pool=None):
+    # df is sorted by ux_end_time: decide the records ending before settled (final) and then the ones ending
+    # after it (provisional, decided again by the next incremental run). Returns both outputs and the state
+    # as of settled.
+    final = (df['ux_end_time'] < settled).to_numpy()
+    final_df, latest_end_times = first_jobs_vectorized(df[final], year, latest_end_times, timezone, gaps, all_jobs, pool)
+    provisional_df, _ = first_jobs_vectorized(df[~final], year, latest_end_times, timezone, gaps, all_jobs, pool)
+    return final_df, provisional_df, latest_end_times
+
+
+def save_settled(final_df, provisional_df, output_file_name, year, output_format='parquet', state=None, gaps=FIRST_JOB_GAPS):
+    # Replace the provisional rows of the last run (state, None on a full run) with the final rows, then write
+    # this run's provisional rows after them. Returns their token and csv offset, for the next run to replace.
+    token = 0
+    if state is not None:
+        token = state['token']
+        if output_format == 'csv':
+            with open(output_file_name, 'r+b') as output_file:
+                output_file.truncate(state['offset'])
+        else:
+            remove_waiting_times(output_file_name, year, token)
+    save_waiting_times(final_df, output_file_name, year, output_format, append=state is not None, token=token, gaps=gaps)
+    offset = os.path.getsize(output_file_name) if output_format == 'csv' else 0
+    save_waiting_times(provisional_df, output_file_name, year, output_format, append=True, token=token + 1, gaps=gaps)
+    return token + 1, offset
+
+
+def save_waiting_times(df, output_file_name, year, output_format='parquet', append=False, token=0, gaps=FIRST_JOB_GAPS):
+    # output_file_name is the dataset directory for parquet (which keeps gaps in its metadata) and the year's file for csv
+    if output_format == 'csv':
+        df.to_csv(output_file_name, index=False, header=not append, mode='a' if append else 'w', chunksize=100000)
+    else:
+        write_waiting_times(df, output_file_name, year, append=append, token=token, gaps=gaps)
+
+
+def waiting_time_per_job_type(input_file_name, output_file_name, year, engine='vectorized', stream=False, batch_rows=STREAM_BATCH_ROWS,
+                              timezone=CLUSTER_TIMEZONE, previous_input_file_name=None, state_file_name=None,
+                              output_format='parquet', collapse_arrays=False, gaps=FIRST_JOB_GAPS, all_jobs=False,
+                              queue_backlog=False, owner_usage=False, workers=1):
+    # With state_file_name, the first run processes the whole year and saves the first-job state;
+    # later runs decide the records after its settled point again and replace the last run's provisional rows.
+    # collapse_arrays counts each array job once (see collapse_array_jobs); it needs the whole year in memory.
+    # gaps are the idle-gap thresholds (seconds) of the first_job_gaps bitmask; all_jobs writes every
+    # job with a 'first_job' flag instead of the first jobs only (vectorized engine). queue_backlog and
+    # owner_usage add each job's queue backlog and its owner's running jobs at submission, from sweeps
+    # over the whole year's file. With workers > 1 the vectorized engine runs owner shards in a process
+    # pool kept for the whole run (see sharded_first_jobs).
+    with owner_pool(workers) as pool:
+        context = context_sweeps(queue_backlog, owner_usage)
+        if state_file_name is not None and os.path.exists(state_file_name):
+            return append_waiting_times(input_file_name, output_file_name, year, state_file_name, timezone, output_format, gaps, all_jobs,
+                                        context, pool)
+
+        # Seed the first-job state with the jobs in the previous year's file still running on Jan 1
+        carried_end_times = None
+        if previous_input_file_name is not None:
+            if os.path.exists(previous_input_file_name):
+                carried_end_times = carry_over_end_times(previous_input_file_name, year, timezone)
+            else:
+                print(f"File not found: {previous_input_file_name}, no carry-over into {year}")
+
+        # The submission context of every job comes from sweeps over the whole year's file
+        events = submission_events(input_file_name, context) if context else None
+
+        if stream:
+            # Write each decided batch as soon as it is ready
+            batches = 0
+            first_jobs = 0
+            for job_type_waiting_df in stream_first_jobs(input_file_name, year, batch_rows, timezone, carried_end_times, events,
+                                                         gaps, all_jobs, pool):
+                with stage('write', len(job_type_waiting_df)):
+                    save_waiting_times(job_type_waiting_df, output_file_name, year, output_format, append=batches > 0, token=batches,
+                                       gaps=gaps)
+                batches += 1
+                first_jobs += len(job_type_waiting_df)
+            if batches == 0:
+                save_waiting_times(pd.DataFrame(columns=output_columns(all_jobs, context)), output_file_name, year, output_format)
+            return first_jobs
+
+        # Read data from the Feather file, only the columns we need
+        with stage('read') as record:
+            df = pd.read_feather(input_file_name, columns=ACCOUNTING_COLUMNS)
+            record['rows_out'] = len(df)
+        df = prepare_jobs(df, year, collapse_arrays, events)
+
+        if engine != 'loop' and state_file_name is not None:
+            # First incremental run: keep the records after the settled point apart for the next run to decide again
+            watermark = int(df['ux_end_time'].max()) if len(df) else 0
+            settled = watermark - WATERMARK_SLACK
+            with stage('first_jobs', len(df)) as record:
+                final_df, provisional_df, latest_end_times = decide_settled(df, year, carried_end_times, settled, timezone, gaps,
+                                                                            all_jobs, pool)
+                record['rows_out'] = len(final_df) + len(provisional_df)
+            with stage('write', record['rows_out']):
+                token, offset = save_settled(final_df, provisional_df, output_file_name, year, output_format, gaps=gaps)
+            write_state(state_file_name, year, settled, watermark, latest_end_times, token, offset, context, gaps)
+            return record['rows_out']
+
+        with stage('first_jobs', len(df)) as record:
+            if engine == 'loop':
+                job_type_waiting_df = first_jobs_loop(df, year, timezone, carried_end_times, gaps)
+            else:
+                job_type_waiting_df, _ = first_jobs_vectorized(df, year, carried_end_times, timezone, gaps, all_jobs, pool)
+            record['rows_out'] = len(job_type_waiting_df)
+
+        # Save the results
+        with stage('write', len(job_type_waiting_df)):
+            save_waiting_times(job_type_waiting_df, output_file_name, year, output_format, gaps=gaps)
+        return len(job_type_waiting_df)
+
+
+def append_waiting_times(input_file_name, output_file_name, year, state_file_name, timezone=CLUSTER_TIMEZONE, output_format='parquet',
+                         gaps=FIRST_JOB_GAPS, all_jobs=False, context=context_sweeps(), pool=None):
+    # Incremental run: accounting records are appended as jobs finish, so every record not yet settled ends
+    # after the saved settled point. Deciding all of them again, in end order, with the state as of that point
+    # gives the same rows a full rebuild would, also for a record written late but ending within WATERMARK_SLACK
+    # of the last watermark; they replace the provisional rows of the last run. (A record written later still,
+    # ending before the settled point, is only reported by a rebuild.)
+    state = read_state(state_file_name)
+    if state['year'] != year:
+        raise ValueError(f"{state_file_name} holds the state of {state['year']}, not {year}")
+    if state['context'] != context:
+        raise ValueError(f"{state_file_name} was written with submission-context sweeps {state['context']}, not {context}; "
+                         'rerun with the same options or rebuild the year')
+    if state['gaps'] != list(gaps):
+        raise ValueError(f"{state_file_name} was written with --gaps {','.join(map(str, state['gaps']))}, not "
+                         f"{','.join(map(str, gaps))}; first_job_gaps bits of the two cannot be mixed within a year")
+
+    with stage('read') as record:
+        df = read_ending_after(input_file_name, state['settled'])
+        record['rows_out'] = len(df)
+    print(f"Records after settled point {state['settled']}:", len(df))
+    df = prepare_jobs(df, year, events=submission_events(input_file_name, context) if context else None)
+    watermark = max(state['watermark'], int(df['ux_end_time'].max()) if len(df) else 0)
+    settled = max(state['settled'], watermark - WATERMARK_SLACK)
+    with stage('first_jobs', len(df)) as record:
+        final_df, provisional_df, latest_end_times = decide_settled(df, year, state['latest_end_times'], settled, timezone, gaps,
+                                                                    all_jobs, pool)
+        record['rows_out'] = len(final_df) + len(provisional_df)
+
+    with stage('write', record['rows_out']):
+        token, offset = save_settled(final_df, provisional_df, output_file_name, year, output_format, state, gaps)
+    write_state(state_file_name, year, settled, watermark, latest_end_times, token, offset, context, gaps)
+    return record['rows_out']
+
+
+def verify_incremental(year, input_template=ACCOUNTING_FILE, output_template=WAITING_TIMES_DIR, output_format='parquet', **options):
+    # Rebuild the year from scratch into a temporary location and compare it with the incremental output
+    # record for record, in stored order and with types: each incremental run writes the records ending in the next
+    # range of end times after the earlier ones, so the order must match a rebuild's. The queue backlog and owner usage
+    # columns, when written, are left out: records settled earlier counted the jobs that had finished by then, a rebuild
+    # counts the later ones too.
+    output_file_name = output_template.format(year=year)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        rebuilt_file_name = os.path.join(temp_dir, os.path.basename(output_file_name))
+        process_year(year, input_template=input_template, output_template=rebuilt_file_name, output_format=output_format, **options)
+        if output_format == 'csv':
+            incremental, rebuilt = pd.read_csv(output_file_name), pd.read_csv(rebuilt_file_name)
+        else:
+            incremental, rebuilt = read_waiting_times(output_file_name, years=[year]), read_waiting_times(rebuilt_file_name, years=[year])
+        provisional = QUEUE_BACKLOG_COLUMNS + OWNER_USAGE_COLUMNS
+        same = incremental.drop(columns=provisional, errors='ignore').equals(rebuilt.drop(columns=provisional, errors='ignore'))
+    print(f"{output_file_name} {'matches' if same else 'DIFFERS FROM'} a full rebuild of {year}")
+    return same
+
+
+def run_log_file(output_file_name, output_format='parquet'):
+    # JSON-lines stage log kept next to the output: inside the dataset directory
+    # (a leading '_' keeps it out of the dataset) or beside the year's CSV
+    if output_format == 'csv':
+        return f'{os.path.splitext(output_file_name)[0]}_runs.jsonl'
+    os.makedirs(output_file_name, exist_ok=True)
+    return os.path.join(output_file_name, '_runs.jsonl')
+
+
+def process_year(year, input_template=ACCOUNTING_FILE, output_template=WAITING_TIMES_DIR, previous_input_template=None,
+                 carry_over=True, state_template=None, queue_depth_dir=None, **options):
+    # One year end to end; templates may contain {year}. The carry-over seed is a bounded
+    # read of the previous year's tail, so years can run in any order and in parallel.
+    # With queue_depth_dir the year's queue-depth series is rebuilt there as well.
+    input_file_name = input_template.format(year=year)
+    output_file_name = output_template.format(year=year)
+    state_file_name = state_template.format(year=year) if state_template else None
+    previous_input_file_name = None
+    if carry_over:
+        previous_input_file_name = (previous_input_template or input_template).format(year=year - 1)
+
+    start_run_log(run_log_file(output_file_name, options.get('output_format', 'parquet')),
+                  run_id=f"{datetime.datetime.now().isoformat(timespec='seconds')}-{os.getpid()}", host=socket.gethostname(),
+                  year=year, engine=options.get('engine', 'vectorized'), stream=options.get('stream', False),
+                  incremental=state_file_name is not None,
+                  collapse_arrays=options.get('collapse_arrays', False), gaps=options.get('gaps', FIRST_JOB_GAPS),
+                  all_jobs=options.get('all_jobs', False), queue_backlog=options.get('queue_backlog', False),
+                  owner_usage=options.get('owner_usage', False), workers=options.get('workers', 1))
+    start_time = time.time()
+    with stage('total') as record:
+        first_jobs = waiting_time_per_job_type(input_file_name, output_file_name, year,
+                                               previous_input_file_name=previous_input_file_name,
+                                               state_file_name=state_file_name, **options)
+        record['rows_out'] = first_jobs
+        if queue_depth_dir is not None:
+            queue_depth_per_year(input_file_name, queue_depth_dir, year, options.get('timezone', CLUSTER_TIMEZONE))
+    running_time = time.time() - start_time
+    return {
+        'year': year,
+        'jobs': ds.dataset(input_file_name, format='feather').count_rows(),
+        'first_jobs': first_jobs,
+        'seconds': running_time,
+        'output': output_file_name,
+    }
+
+
+def gap_list(text):
+    # "300,3600,86400" -> [300, 3600, 86400]; at most 8 thresholds fit the uint8 bitmask
+    gaps = [int(gap) for gap in text.split(',')]
+    if len(gaps) > 8:
+        raise argparse.ArgumentTypeError('at most 8 gap thresholds')
+    return gaps
+
+
+def node_workers(default):
+    # Cores granted by the qsub node (NSLOTS on SGE)
+    return int(os.environ.get('NSLOTS', default))
+
+
+def backfill(years, processes=None, **options):
+    # Rebuild several years in a process pool sized to the node; returns per-year summaries
+    processes = processes or node_workers(os.cpu_count())
+    with ProcessPoolExecutor(max_workers=min(processes, len(years))) as pool:
+        futures = {year: pool.submit(process_year, year, **options) for year in years}
+        return [futures[year].result() for year in years]
+
+
+def print_throughput(summaries):
+    print(f"{'Year':<6} {'Jobs':>12} {'First jobs':>12} {'Seconds':>10} {'Jobs/sec':>12}")
+    print("-" * 56)
+    for summary in summaries:
+        rate = summary['jobs'] / summary['seconds'] if summary['seconds'] else float('nan')
+        print(f"{summary['year']:<6} {summary['jobs']:>12,} {summary['first_jobs']:>12,} {summary['seconds']:>10.1f} {rate:>12,.0f}")
 
 
 
 # Example usage
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process accounting data.')
-    parser.add_argument('year', type=int, help='Year of the data to process')
+    parser.add_argument('year', type=int, help='Year of the data to process (first year with --through)')
+    parser.add_argument('--through', type=int, help='Backfill every year from year to this one in a process pool')
+    parser.add_argument('--workers', type=int,
+                        help='Processes: one per year with --through (default: $NSLOTS, else the CPU count), otherwise '
+                             'owner shards of the year for the vectorized engine (default: $NSLOTS, else 1)')
+    parser.add_argument('--engine', choices=ENGINES, default='vectorized',
+                        help='First-job engine: columnar (default) or the row-by-row reference loop')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the accounting file as memory-mapped record batches, carrying first-job state across batches')
+    parser.add_argument('--batch-rows', type=int, default=STREAM_BATCH_ROWS, help='Rows per record batch with --stream')
+    parser.add_argument('--timezone', default=CLUSTER_TIMEZONE,
+                        help=f'Timezone for year/month/day/hour/weekday of submissions (default: {CLUSTER_TIMEZONE})')
+    parser.add_argument('--no-carry-over', action='store_true',
+                        help="Do not seed first-job state with the previous year's jobs still running on Jan 1")
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process records past the saved ux_end_time watermark and append them to the output')
+    parser.add_argument('--state', help=f'State file for --incremental, may contain {{year}} '
+                                        f'(default: {STATE_FILE}, with --all-jobs {ALL_JOBS_STATE_FILE})')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check that the incremental output equals a full rebuild of the year')
+    parser.add_argument('--collapse-arrays', action='store_true',
+                        help='Count each array job once: earliest start, latest end and the number of tasks')
+    parser.add_argument('--all-jobs', action='store_true',
+                        help="Write every job's wait with a first_job flag instead of the first jobs only")
+    parser.add_argument('--gaps', type=gap_list, default=FIRST_JOB_GAPS,
+                        help=f'Comma-separated idle-gap thresholds in seconds, one bit each of first_job_gaps '
+                             f'(default: {",".join(map(str, FIRST_JOB_GAPS))})')
+    parser.add_argument('--queue-backlog', action='store_true',
+                        help="Record each job's queue backlog at submission (pending_jobs/pending_slots); reads the "
+                             'whole year, so it is slower and memory is not bounded by --stream or --incremental')
+    parser.add_argument('--owner-usage', action='store_true',
+                        help="Record the jobs and slots each job's owner had running at submission; reads the "
+                             'whole year, so it is slower and memory is not bounded by --stream or --incremental')
+    parser.add_argument('--queue-depth', nargs='?', const=QUEUE_DEPTH_DIR, metavar='DIR',
+                        help=f'Also rebuild the per-queue {QUEUE_DEPTH_BIN_SECONDS // 60}-minute pending/running series '
+                             f'(default DIR: {QUEUE_DEPTH_DIR})')
+    parser.add_argument('--input', default=ACCOUNTING_FILE, help=f'Accounting Feather file, may contain {{year}} (default: {ACCOUNTING_FILE})')
+    parser.add_argument('--previous-input', help="Previous year's accounting Feather file, {year} is the previous year (default: --input)")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='parquet',
+                        help='Output: year=/month= partitioned Parquet dataset (default) or one CSV per year')
+    parser.add_argument('--output', help=f'Output dataset directory, or CSV with --format csv (may contain {{year}}); '
+                                         f'default: {WAITING_TIMES_DIR} or {OUTPUT_FILE}, '
+                                         f'with --all-jobs {ALL_JOBS_DIR} or {ALL_JOBS_OUTPUT_FILE}')
     args = parser.parse_args()
+    if args.stream and args.engine == 'loop':
+        parser.error('--stream requires the vectorized engine')
+    if args.all_jobs and args.engine == 'loop':
+        parser.error('--all-jobs requires the vectorized engine')
+    if args.incremental and (args.stream or args.engine == 'loop' or args.through is not None):
+        parser.error('--incremental runs a single year with the in-memory vectorized engine')
+    if args.collapse_arrays and (args.stream or args.incremental):
+        parser.error('--collapse-arrays needs the whole year in memory (no --stream or --incremental)')
 
-    year = args.year
-    input_file_name = f'/projectnb/rcsmetrics/accounting/data/scc/{year}.feather'
-    output_file_name = f'/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_per_job_type.csv'
-
-    start_time = time.time()
-    waiting_time_per_job_type(input_file_name, output_file_name, year)
-    end_time = time.time()
-
-    running_time = end_time - start_time
+    if args.all_jobs:
+        output_template = args.output or (ALL_JOBS_OUTPUT_FILE if args.format == 'csv' else ALL_JOBS_DIR)
+        state_template = args.state or ALL_JOBS_STATE_FILE
+    else:
+        output_template = args.output or (OUTPUT_FILE if args.format == 'csv' else WAITING_TIMES_DIR)
+        state_template = args.state or STATE_FILE
+    options = dict(input_template=args.input, output_template=output_template, previous_input_template=args.previous_input,
+                   carry_over=not args.no_carry_over, engine=args.engine, stream=args.stream,
+                   batch_rows=args.batch_rows, timezone=args.timezone, output_format=args.format,
+                   collapse_arrays=args.collapse_arrays, gaps=args.gaps, all_jobs=args.all_jobs, queue_backlog=args.queue_backlog,
+                   owner_usage=args.owner_usage)
 
-    print(f"First job waiting times per job type saved to {output_file_name}")
-    print(f"Running time: {running_time} seconds")
+    if args.verify:
+        sys.exit(0 if verify_incremental(args.year, **options) else 1)
 
+    if args.through is not None:
+        start_time = time.time()
+        summaries = backfill(list(range(args.year, args.through + 1)), args.workers,
+                             queue_depth_dir=args.queue_depth, **options)
+        print_throughput(summaries)
+        print(f"Running time: {time.time() - start_time} seconds")
+    else:
+        summary = process_year(args.year, state_template=state_template if args.incremental else None, queue_depth_dir=args.queue_depth,
+                               workers=1 if args.engine == 'loop' else args.workers or node_workers(1), **options)
+        print(f"First job waiting times per job type saved to {summary['output']}")
+        print(f"Running time: {summary['seconds']} seconds")
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Benchmark every ETL stage on synthetic accounting data (generate_accounting.py) and compare
+# against a stored baseline. Stage timings come from the same run log GetQueueTime.py writes.
+# Timings depend on the machine, so no baseline is shipped: record one with --save-baseline first.
+import argparse
+import json
+import os
+import sys
+import time
+
+import helpers
+import GetQueueTime
+import process_waiting_times
+from generate_accounting import generate_accounting
+
+SIZES = ['1M', '10M', '50M']
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+# A stage regresses when it takes this many times its baseline
+TOLERANCE = 1.25
+
+
+def parse_size(text):
+    # "10M" -> 10_000_000, "250k" -> 250_000
+    multiplier = {'k': 1_000, 'm': 1_000_000}.get(text[-1].lower(), 1)
+    return int(float(text[:-1] if multiplier > 1 else text) * multiplier)
+
+
+def stage_totals(records):
+    # Sum seconds and rows over repeated stages (stream batches), keep the highest of the stage's own
+    # peak RSS (None where the run log could not measure it)
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record['stage'], {'seconds': 0.0, 'rows': 0, 'peak_rss_mb': None})
+        total['seconds'] += record['seconds']
+        rows = record['rows_in'] if record['rows_in'] is not None else record['rows_out']
+        total['rows'] += rows or 0
+        if record['peak_rss_mb'] is not None:
+            total['peak_rss_mb'] = max(total['peak_rss_mb'] or 0, record['peak_rss_mb'])
+    for total in totals.values():
+        total['seconds'] = round(total['seconds'], 3)
+        total['rows_per_sec'] = round(total['rows'] / total['seconds']) if total['seconds'] else None
+    return totals
+
+
+def benchmark_size(rows, work_dir, year=2024, seed=0, regenerate=False, **options):
+    # Generate (or reuse) rows synthetic records, run the yearly ETL and the consolidation step on them
+    data_dir = os.path.join(work_dir, f'{rows}')
+    os.makedirs(data_dir, exist_ok=True)
+    input_file_name = os.path.join(data_dir, f'{year}.feather')
+    queue_info_file_name = os.path.join(data_dir, 'queue_info.csv')
+    if regenerate or not os.path.exists(input_file_name):
+        start_time = time.time()
+        generate_accounting(input_file_name, year, rows, seed=seed, queue_info_file_name=queue_info_file_name)
+        print(f"Generated {rows:,} records in {time.time() - start_time:.1f} seconds")
+    helpers.QUEUE_INFO_PATH = queue_info_file_name
+
+    output_dir = os.path.join(data_dir, 'waiting_times')
+    GetQueueTime.process_year(year, input_template=input_file_name, output_template=output_dir, carry_over=False, **options)
+
+    # The consolidation stages are recorded into the same run log; rebuild so the year is parsed, not
+    # reused from the fragment of an earlier benchmark run
+    with helpers.stage('consolidate_load') as record:
+        dataset = process_waiting_times.load_dataset([year], accounting_dir=data_dir, waiting_times_dir=output_dir, rebuild=True)
+        record['rows_out'] = len(dataset)
+    with helpers.stage('consolidate_save', len(dataset)):
+        process_waiting_times.save_filtered_data(dataset, output_dir=data_dir)
+    with helpers.stage('consolidate_publish', len(dataset)):
+        process_waiting_times.publish_dashboard_dataset(dataset, output_dir=os.path.join(data_dir, 'dashboard'))
+    return stage_totals(helpers.run_log.records)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    # Print every stage against its baseline; returns the stages that regressed
+    regressions = []
+    print(f"{'Size':<6} {'Stage':<18} {'Seconds':>10} {'Baseline':>10} {'Ratio':>7} {'Rows/sec':>14} {'Peak RSS MB':>12}")
+    print("-" * 83)
+    for size, stages in results.items():
+        for name, total in stages.items():
+            base = baseline.get(size, {}).get(name)
+            ratio = total['seconds'] / base['seconds'] if base and base['seconds'] else None
+            flag = ''
+            if ratio is not None and ratio > tolerance:
+                regressions.append((size, name, ratio))
+                flag = '  REGRESSION'
+            base_seconds = f"{base['seconds']:.3f}" if base else '-'
+            ratio_text = f"{ratio:.2f}" if ratio is not None else '-'
+            rate = f"{total['rows_per_sec']:,}" if total['rows_per_sec'] is not None else '-'
+            peak = f"{total['peak_rss_mb']:.0f}" if total['peak_rss_mb'] is not None else '-'
+            print(f"{size:<6} {name:<18} {total['seconds']:>10.3f} {base_seconds:>10} {ratio_text:>7} {rate:>14} {peak:>12}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the ETL stages on synthetic accounting data.')
+    parser.add_argument('--sizes', default=','.join(SIZES), help=f'Comma-separated record counts (default: {",".join(SIZES)})')
+    parser.add_argument('--work-dir', default='bench', help='Where synthetic inputs and outputs are kept (default: ./bench)')
+    parser.add_argument('--year', type=int, default=2024)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--regenerate', action='store_true', help='Regenerate synthetic inputs even if they exist')
+    parser.add_argument('--engine', choices=GetQueueTime.ENGINES, default='vectorized')
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--workers', type=int, default=1, help='Owner shards of the vectorized engine (default: 1)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help=f'Baseline JSON (default: {BASELINE_FILE})')
+    parser.add_argument('--save-baseline', action='store_true', help='Store this run as the new baseline (needed once per machine: '
+                                                                          'without a baseline the run fails)')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help=f'Allowed slowdown ratio (default: {TOLERANCE})')
+    args = parser.parse_args()
+
+    results = {}
+    for size in args.sizes.split(','):
+        print(f"=== {size} records ===")
+        results[size] = benchmark_size(parse_size(size), args.work_dir, args.year, args.seed, args.regenerate,
+                                       engine=args.engine, stream=args.stream, workers=args.workers)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({**baseline, **results}, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        sys.exit(0)
+
+    # Without a baseline nothing was compared: fail rather than pass silently
+    unbaselined = [size for size in results if size not in baseline]
+    if unbaselined:
+        print(f"No baseline for {','.join(unbaselined)} in {args.baseline}: nothing was checked for regressions. "
+              f"Record one on this machine with --save-baseline.", file=sys.stderr)
+    if regressions:
+        print(f"{len(regressions)} stage(s) slower than {args.tolerance}x the baseline")
+    if unbaselined or regressions:
+        sys.exit(1)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Synthetic SGE accounting data for benchmarking the ETL without /projectnb.
+# Writes a yearly Feather file with the columns GetQueueTime.py reads, in job completion
+# order like the real accounting file, and a matching queue_info.csv.
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from GetQueueTime import ACCOUNTING_COLUMNS, year_start, CLUSTER_TIMEZONE
+
+# queue name -> (share of jobs, class_user, class_own, has GPUs)
+QUEUES = {
+    'a128': (0.30, 'shared', 'shared', False),
+    'b': (0.15, 'shared', 'shared', False),
+    'mpi-28': (0.10, 'shared', 'shared', False),
+    'l40s': (0.08, 'shared', 'shared', True),
+    'a40': (0.05, 'shared', 'shared', True),
+    'csgpu': (0.04, 'buyin', 'buyin', True),
+    'bme': (0.12, 'buyin', 'buyin', False),
+    'physics-pub': (0.10, 'shared', 'buyin', False),
+    'econ': (0.06, 'buyin', 'buyin', False),
+}
+OPTIONS_CPU = ['', 'h_rt=12:00:00', 'mem_per_core=8G', 'h_rt=48:00:00,mem_per_core=4G']
+OPTIONS_GPU = ['gpus=1', 'gpus=1,gpu_c=7.0', 'gpus=1,gpu_memory=24G', 'gpus=2', 'gpus=2,gpu_c=8.0', 'gpus=4,gpu_memory=48G']
+OPTIONS_GPU_WEIGHTS = [0.45, 0.15, 0.1, 0.15, 0.1, 0.05]
+MPI_PES = ['mpi_16_tasks_per_node', 'mpi_28_tasks_per_node', 'mpi128_a']
+CHUNK_ROWS = 2_000_000
+
+
+def parse_queue_mix(text):
+    # "a128=0.5,l40s=0.2" -> {'a128': 0.5, 'l40s': 0.2}
+    mix = {}
+    for item in text.split(','):
+        name, weight = item.split('=')
+        if name not in QUEUES:
+            raise argparse.ArgumentTypeError(f'unknown queue {name}; known: {", ".join(QUEUES)}')
+        mix[name] = float(weight)
+    return mix
+
+
+def dictionary_strings(rng, values, size, p=None):
+    # Arrow string column drawn from a few values, built from indices without Python string objects
+    indices = rng.choice(len(values), size=size, p=p).astype(np.int32)
+    return pa.DictionaryArray.from_arrays(pa.array(indices), pa.array(values, type=pa.string())).cast(pa.string())
+
+
+def generate_chunk(rng, first_end, size, end_step, owners, owner_p, queue_names, queue_p, array_fraction, mpi_slave_fraction,
+                   first_job_number):
+    # Records are generated backwards from their end time, so every chunk continues the
+    # previous one in completion order: end -> start (run time) -> submission (wait)
+    end = first_end + np.cumsum(rng.exponential(end_step, size))
+    run_time = rng.lognormal(7.5, 1.6, size)  # median ~30 min
+    wait = rng.lognormal(5.0, 2.0, size) * (rng.random(size) < 0.9)  # median ~2.5 min, 10% start at once
+    start = end - run_time
+    submission = start - wait
+
+    queue = rng.choice(len(queue_names), size=size, p=queue_p)
+    owner = rng.choice(len(owners), size=size, p=owner_p)
+
+    # Array jobs: tasks of one job share its owner, queue, job number and submission time
+    job_number = first_job_number + np.arange(size)
+    task_number = np.zeros(size, dtype=np.int64)
+    array_rows = np.flatnonzero(rng.random(size) < array_fraction)
+    if len(array_rows):
+        # neighbouring array rows (close in end time) form one job of ~20 tasks
+        array_job = np.sort(rng.integers(0, max(1, len(array_rows) // 20), len(array_rows)))
+        rows = array_rows
+        leader = rows[np.searchsorted(array_job, array_job)]
+        job_number[rows] = job_number[leader]
+        owner[rows] = owner[leader]
+        queue[rows] = queue[leader]
+        task_number[rows] = np.arange(len(rows)) - np.searchsorted(array_job, array_job) + 1
+        earliest = np.minimum.reduceat(submission[rows], np.flatnonzero(np.r_[True, array_job[1:] != array_job[:-1]]))
+        submission[rows] = earliest[np.unique(array_job, return_inverse=True)[1]]
+
+    gpu_queue = np.array([QUEUES[name][3] for name in queue_names])[queue]
+
+    # Parallel environment and slots: single core, OpenMP or MPI (MPI only on CPU queues)
+    kind = rng.choice(3, size=size, p=[0.55, 0.35, 0.10])
+    kind[gpu_queue & (kind == 2)] = 1
+    mpi_slave = (rng.random(size) < mpi_slave_fraction)
+    kind[mpi_slave] = 2
+    slots = np.where(kind == 0, 1, np.where(kind == 1, rng.choice([2, 4, 8, 16, 28], size=size), 16 * rng.integers(1, 9, size)))
+    pe_index = np.where(kind == 0, 0, np.where(kind == 1, 1, 2 + rng.integers(0, len(MPI_PES), size)))
+    granted_pe = pa.DictionaryArray.from_arrays(pa.array(pe_index.astype(np.int32)),
+                                                pa.array(['NONE', 'omp'] + MPI_PES)).cast(pa.string())
+    pe_taskid = np.where(mpi_slave, (rng.integers(1, 64, size)).astype(str), None)
+
+    options_cpu = rng.choice(len(OPTIONS_CPU), size=size)
+    options_gpu = rng.choice(len(OPTIONS_GPU), size=size, p=OPTIONS_GPU_WEIGHTS)
+    options_index = np.where(gpu_queue, len(OPTIONS_CPU) + options_gpu, options_cpu).astype(np.int32)
+    options = pa.DictionaryArray.from_arrays(pa.array(options_index), pa.array(OPTIONS_CPU + OPTIONS_GPU)).cast(pa.string())
+
+    columns = {
+        'ux_submission_time': pa.array(np.floor(submission)),
+        'ux_start_time': pa.array(np.floor(start)),
+        'ux_end_time': pa.array(np.floor(end)),
+        'granted_pe': granted_pe,
+        'slots': pa.array(slots.astype(np.int64)),
+        'options': options,
+        'pe_taskid': pa.array(pe_taskid, type=pa.string()),
+        'qname': pa.DictionaryArray.from_arrays(pa.array(queue.astype(np.int32)), pa.array(queue_names)).cast(pa.string()),
+        'job_number': pa.array(job_number),
+        'owner': pa.DictionaryArray.from_arrays(pa.array(owner.astype(np.int32)), pa.array(owners)).cast(pa.string()),
+        'job_name': dictionary_strings(rng, ['run.sh', 'train.qsub', 'sim', 'job'], size),
+        'task_number': pa.array(task_number),
+    }
+    return pa.record_batch([columns[name] for name in ACCOUNTING_COLUMNS], names=ACCOUNTING_COLUMNS), end[-1]
+
+
+def generate_accounting(output_file_name, year, rows, owners=2000, queue_mix=None, array_fraction=0.2,
+                        mpi_slave_fraction=0.03, seed=0, timezone=CLUSTER_TIMEZONE, queue_info_file_name=None):
+    # Write rows accounting records ending during year; returns the queue_info.csv path
+    rng = np.random.default_rng(seed)
+    queue_mix = queue_mix or {name: share for name, (share, _, _, _) in QUEUES.items()}
+    queue_names = list(queue_mix)
+    queue_p = np.array([queue_mix[name] for name in queue_names], dtype=float)
+    queue_p /= queue_p.sum()
+    owner_names = [f'user{i:05d}' for i in range(owners)]
+    owner_p = 1 / np.arange(1, owners + 1) ** 1.1  # a few heavy users, a long tail
+    owner_p /= owner_p.sum()
+
+    first_end = year_start(year, timezone)
+    end_step = (year_start(year + 1, timezone) - first_end) / rows
+
+    writer = None
+    try:
+        written = 0
+        while written < rows:
+            size = min(CHUNK_ROWS, rows - written)
+            batch, last_end = generate_chunk(rng, first_end, size, end_step, owner_names, owner_p, queue_names, queue_p,
+                                             array_fraction, mpi_slave_fraction, 1 + written)
+            if writer is None:
+                writer = pa.ipc.new_file(output_file_name, batch.schema,
+                                         options=pa.ipc.IpcWriteOptions(compression='lz4'))
+            writer.write_batch(batch)
+            first_end = last_end
+            written += size
+    finally:
+        if writer is not None:
+            writer.close()
+
+    queue_info_file_name = queue_info_file_name or os.path.join(os.path.dirname(output_file_name) or '.', 'queue_info.csv')
+    pd.DataFrame({
+        'queuename': list(QUEUES),
+        'class_user': [QUEUES[name][1] for name in QUEUES],
+        'class_own': [QUEUES[name][2] for name in QUEUES],
+    }).to_csv(queue_info_file_name, index=False)
+    return queue_info_file_name
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write a synthetic yearly SGE accounting Feather file.')
+    parser.add_argument('output', help='Feather file to write, e.g. bench/2024.feather')
+    parser.add_argument('--year', type=int, default=2024)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--owners', type=int, default=2000)
+    parser.add_argument('--queue-mix', type=parse_queue_mix, help=f'name=share,... over {", ".join(QUEUES)}')
+    parser.add_argument('--array-fraction', type=float, default=0.2, help='Share of records that are array-job tasks')
+    parser.add_argument('--mpi-slave-fraction', type=float, default=0.03, help='Share of records that are MPI slave tasks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--queue-info', help='queue_info.csv to write (default: next to the output)')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    queue_info_file_name = generate_accounting(args.output, args.year, args.rows, args.owners, args.queue_mix,
+                                               args.array_fraction, args.mpi_slave_fraction, args.seed,
+                                               queue_info_file_name=args.queue_info)
+    print(f"{args.rows:,} records written to {args.output} ({queue_info_file_name}) in {time.time() - start_time:.1f} seconds")
@@ -10,19 +10,11 @@ now = datetime.datetime.now()
 # DATA LOADING & PREP
 dataset = pd.read_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_GPU.feather")
 
-# Ensure 'year' column is integer
-dataset["year"] = dataset["year"].astype(int)
-
-# Define ordered months
+# 'year' (int16) and 'month' (ordered categorical) are stored typed by process_waiting_times.py
 month_order = [
     "Jan", "Feb", "Mar", "Apr", "May", "Jun",
     "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"
 ]
-dataset["month"] = pd.Categorical(
-    dataset["month"], 
-    categories=month_order, 
-    ordered=True
-)
 
 ICONS = {
     "min": fa.icon_svg("arrow-down"),
@@ -279,7 +271,7 @@ def gpu_job_server(input, output, session, selected_year, selected_month):
         df["first_job_waiting_time"] = df["first_job_waiting_time"] / 60  # Now in minutes
 
         # Compute median waiting time
-        medians = df.groupby("job_type")["first_job_waiting_time"].median().reset_index()
+        medians = df.groupby("job_type", observed=True)["first_job_waiting_time"].median().reset_index()
 
         # Get top 5 job_types with highest median
         top5 = medians.nlargest(5, "first_job_waiting_time")["job_type"].tolist()
@@ -289,7 +281,7 @@ def gpu_job_server(input, output, session, selected_year, selected_month):
 
         # Group again using the new column
         grouped = (
-            df.groupby("job_type_grouped")["first_job_waiting_time"]
+            df.groupby("job_type_grouped", observed=True)["first_job_waiting_time"]
             .median()
             .reset_index()
             .sort_values(by="first_job_waiting_time", ascending=True)
@@ -1,32 +1,510 @@
 import pandas as pd
 import numpy as np
 import datetime
+import os
+import re
+import shutil
+import json
+import time
+import resource
+import contextlib
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
-def determine_job_type(df): 
-    def get_job_type(row):
-        if row['options'] and 'gpus=' in row['options']:
-            return 'GPU'
-        elif row['slots'] == 1:
-            return '1-p'
-        elif row['granted_pe'] is not None and any(keyword in row['granted_pe'] for keyword in ['tasks_per_node', 'mpi_', 'mpi128']):
-            return 'MPI'
-        else:
-            return 'OMP'
-
-    df['job_type'] = df.apply(get_job_type, axis=1)
+MPI_PE_KEYWORDS = ['tasks_per_node', 'mpi_', 'mpi128']
+
+
+def contains_any(series, keywords):
+    # Substring test run once per distinct value (categories) and broadcast back through the codes.
+    # Returns, per row, the index of the first keyword found, or -1 (also for missing values).
+    values = series.astype('category')
+    categories = values.cat.categories.astype(str)
+    matched = np.full(len(categories) + 1, -1, dtype=np.int8)  # last slot catches code -1 (missing)
+    for i, keyword in reversed(list(enumerate(keywords))):
+        matched[:-1][categories.str.contains(keyword, regex=False)] = i
+    return matched[values.cat.codes.to_numpy()]
+
+
+def determine_job_type(df):
+    # Same precedence as the old row-wise rules: GPU request, then single slot, then MPI parallel environment, else OMP.
+    # job_type_rule records which rule (and keyword) matched, for reclassification audits.
+    gpu = contains_any(df['options'], ['gpus=']) >= 0
+    single_slot = (df['slots'] == 1).to_numpy()
+    mpi_keyword = contains_any(df['granted_pe'], MPI_PE_KEYWORDS)
+    mpi = mpi_keyword >= 0
+
+    df['job_type'] = np.select([gpu, single_slot, mpi], ['GPU', '1-p', 'MPI'], default='OMP').astype(object)
+    rules = ['options:gpus=', 'slots==1'] + [f'granted_pe:{keyword}' for keyword in MPI_PE_KEYWORDS] + ['default']
+    rule = np.select([gpu, single_slot, mpi], [0, 1, 2 + mpi_keyword], default=len(rules) - 1)
+    df['job_type_rule'] = pd.Categorical.from_codes(rule, categories=rules)
     return df
 
     
-def check_shared_buyin(df):
-    # Load the queue information from the CSV file
-    queue_info_path = '/projectnb/scv/utilization/katia/queue_info.csv'
-    queue_info = pd.read_csv(queue_info_path)
+# GPU request fields in the SGE options string, e.g. "gpus=2,gpu_c=8.0,gpu_memory=48G"
+GPU_COUNT_PATTERN = r'\bgpus=(\d+)'
+GPU_CAPABILITY_PATTERN = r'\bgpu_c=(\d+(?:\.\d+)?)'
+GPU_MEMORY_PATTERN = r'\bgpu_memory=(\d+(?:\.\d+)?)\s*([KMGT]?)'
+MEMORY_UNIT_GB = {'': 2**-30, 'K': 2**-20, 'M': 2**-10, 'G': 1, 'T': 2**10}
+
+
+def gpu_request(options):
+    # Requested GPU count, minimum compute capability (gpu_c) and GPU memory in GB, parsed once per
+    # distinct options string and broadcast through the categorical codes. Jobs without a GPU
+    # request get gpus 0 and missing gpu_c / gpu_memory_gb.
+    values = options.astype('category')
+    categories = pd.Series(values.cat.categories.astype(str))
+    memory = categories.str.extract(GPU_MEMORY_PATTERN, flags=re.IGNORECASE)
+    parsed = pd.DataFrame({
+        'gpus': categories.str.extract(GPU_COUNT_PATTERN, expand=False).astype(float).fillna(0),
+        'gpu_c': categories.str.extract(GPU_CAPABILITY_PATTERN, expand=False).astype(float),
+        'gpu_memory_gb': memory[0].astype(float) * memory[1].str.upper().map(MEMORY_UNIT_GB),
+    })
+    # one more row for missing options (code -1)
+    parsed.loc[len(parsed)] = [0, np.nan, np.nan]
+    codes = values.cat.codes.to_numpy()
+    return pd.DataFrame({
+        'gpus': parsed['gpus'].to_numpy(dtype=np.int64)[codes],
+        'gpu_c': parsed['gpu_c'].to_numpy()[codes],
+        'gpu_memory_gb': parsed['gpu_memory_gb'].to_numpy()[codes],
+    }, index=options.index)
+
+
+QUEUE_INFO_PATH = '/projectnb/scv/utilization/katia/queue_info.csv'
+QUEUE_CLASS_COLUMNS = ['class_user', 'class_own']
+_queue_info_cache = {}  # path -> (mtime, queue_info)
+
+
+def load_queue_info(queue_info_path=None):
+    # Queue metadata indexed by queuename, read once per process and re-read only when the file's mtime changes
+    queue_info_path = queue_info_path or QUEUE_INFO_PATH
+    mtime = os.path.getmtime(queue_info_path)
+    cached = _queue_info_cache.get(queue_info_path)
+    if cached is None or cached[0] != mtime:
+        queue_info = pd.read_csv(queue_info_path)
+        # a repeated queuename keeps its last row, like the dict lookups this replaces
+        queue_info = queue_info.drop_duplicates(subset='queuename', keep='last').set_index('queuename')
+        for column in QUEUE_CLASS_COLUMNS:
+            queue_info[column] = queue_info[column].astype('category')
+        cached = _queue_info_cache[queue_info_path] = (mtime, queue_info)
+    return cached[1]
+
+
+def unmapped_queues(qname, queue_info_path=None):
+    # Job counts per queue name in qname (a Series; counted through the codes when categorical)
+    # that has no row in queue_info.csv
+    queue_info = load_queue_info(queue_info_path)
+    counts = qname.value_counts()
+    return counts[(counts > 0) & ~counts.index.isin(queue_info.index)]
+
+
+def check_shared_buyin(df, queue_info_path=None):
+    queue_info = load_queue_info(queue_info_path)
+
+    # Join class_user and class_own on 'qname': look up each distinct queue once, then broadcast through the codes
+    qname = df['qname'].astype('category')
+    rows = np.append(queue_info.index.get_indexer(qname.cat.categories), -1)[qname.cat.codes.to_numpy()]
+    for column in QUEUE_CLASS_COLUMNS:
+        classes = queue_info[column]
+        codes = np.append(classes.cat.codes.to_numpy(), -1)  # unmapped queues (row -1) get a missing value
+        df[column] = pd.Categorical.from_codes(codes[rows], dtype=classes.dtype)
+
+    unmapped = unmapped_queues(qname, queue_info_path)
+    if len(unmapped):
+        print(f'Queues missing from {queue_info_path or QUEUE_INFO_PATH}:',
+              ', '.join(f'{queue} ({jobs} jobs)' for queue, jobs in unmapped.items()))
+
+    return df
+
+
+# Typed layout of the per-job-type waiting times: one zstd Parquet dataset, hive-partitioned by year and month
+WAITING_TIMES_DIR = '/projectnb/rcs-intern/Jiazheng/accounting/waiting_times'
+# Every job's wait (GetQueueTime.py --all-jobs), same layout with a first_job flag; about 10x the rows,
+# so readers should ask for the months they need
+ALL_JOBS_DIR = '/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_all_jobs'
+MONTH_ORDER = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+               "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+# Compact schema of the waiting-time records, applied whenever they are saved so that Feather and
+# Parquet files load back with exactly these dtypes
+WAITING_TIME_TYPES = {
+    'job_type': 'category',
+    'class_user': 'category',
+    'class_own': 'category',
+    'first_job_waiting_time': 'int32',
+    'month': pd.CategoricalDtype(MONTH_ORDER, ordered=True),
+    'year': 'int16',
+    'day': 'uint8',
+    'job_number': 'int32',
+    'slots': 'uint16',
+    'hour': 'uint8',
+    'weekday': 'uint8',
+    'gpus': 'uint8',
+    'gpu_c': 'float32',
+    'gpu_memory_gb': 'float32',
+    'tasks': 'uint32',
+    # Optional (GetQueueTime.py --queue-backlog) and provisional: the backlog counts only the jobs that had
+    # finished when the record was written, so records appended by an incremental run can be lower than
+    # a full rebuild of the year
+    'pending_jobs': 'uint32',
+    'pending_slots': 'uint32',
+    'first_job_gaps': 'uint8',
+    # Optional (--owner-usage) and provisional in the same way: only jobs finished by then are counted
+    'owner_running_jobs': 'uint32',
+    'owner_running_slots': 'uint32',
+    'first_job': 'bool',
+}
+WAITING_TIME_PARTITIONING = ds.partitioning(pa.schema([('year', pa.int16()), ('month', pa.string())]), flavor='hive')
+
+
+# Idle-gap thresholds (seconds) of the first_job_gaps bitmask: bit i is set when the owner had no job of
+# that type running for more than FIRST_JOB_GAPS[i] before the submission (5 min, 1 h, 24 h)
+FIRST_JOB_GAPS = [300, 3600, 86400]
+# The thresholds a file was written with are kept in its schema metadata under this key; readers put
+# them in df.attrs['first_job_gaps']. Files without it were written with FIRST_JOB_GAPS.
+FIRST_JOB_GAPS_METADATA = b'first_job_gaps'
+
+
+def gaps_metadata(gaps):
+    return {FIRST_JOB_GAPS_METADATA: ','.join(map(str, gaps)).encode()}
+
+
+def stored_gaps(metadata):
+    # Thresholds recorded by gaps_metadata in a schema's metadata, FIRST_JOB_GAPS if none
+    value = (metadata or {}).get(FIRST_JOB_GAPS_METADATA)
+    return [int(gap) for gap in value.decode().split(',')] if value else FIRST_JOB_GAPS
+
+
+def common_gaps(gap_lists, what='records'):
+    # The one set of thresholds of several files or years; bits of different thresholds cannot be mixed
+    distinct = sorted({tuple(gaps) for gaps in gap_lists})
+    if len(distinct) > 1:
+        raise ValueError(f'{what} were written with different first_job_gaps thresholds {distinct}; read them separately '
+                         'or rebuild them with the same --gaps')
+    return list(distinct[0]) if distinct else FIRST_JOB_GAPS
+
+
+def first_job_gap(df, seconds, gaps=None):
+    # Records that are first jobs when the definition asks for an idle gap of more than seconds
+    # (0 is the default definition, every record). gaps defaults to the thresholds the records
+    # were written with (df.attrs, set by the readers).
+    if seconds == 0:
+        return pd.Series(True, index=df.index)
+    gaps = gaps or df.attrs.get('first_job_gaps', FIRST_JOB_GAPS)
+    if seconds not in gaps:
+        raise ValueError(f'first_job_gaps was written for idle gaps of {gaps} seconds, not {seconds}')
+    return (df['first_job_gaps'] & (1 << gaps.index(seconds))) > 0
+
+
+def compact_waiting_times(df):
+    # Cast waiting-time records to WAITING_TIME_TYPES (columns that are present). An integer column
+    # with missing values, e.g. hour/weekday of years written before they existed, gets the nullable
+    # variant of its type (int32 -> Int32) instead of failing.
+    types = {}
+    for column, dtype in WAITING_TIME_TYPES.items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        if isinstance(dtype, str) and 'int' in dtype and df[column].isna().any():
+            dtype = dtype.capitalize() if dtype.startswith('int') else 'U' + dtype[1:].capitalize()
+        if df[column].dtype != dtype:
+            types[column] = dtype
+    return df.astype(types) if types else df
+
+
+def write_waiting_times(df, base_dir, year, append=False, token=0, gaps=FIRST_JOB_GAPS):
+    # Write one year of records into its year=/month= partitions. Without append the year is
+    # replaced; with append the records land in new files named after token, which sort after
+    # the existing ones so reading the partition back keeps the order they were written in.
+    # gaps, the thresholds of first_job_gaps, are kept in every file's schema metadata.
+    year_dir = os.path.join(base_dir, f'year={year}')
+    if not append and os.path.isdir(year_dir):
+        shutil.rmtree(year_dir)
+    if df.empty:
+        return
+    df = compact_waiting_times(df).astype({'month': str})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    ds.write_dataset(
+        table.replace_schema_metadata({**table.schema.metadata, **gaps_metadata(gaps)}),
+        base_dir,
+        format='parquet',
+        partitioning=WAITING_TIME_PARTITIONING,
+        basename_template=f'part-{token:012d}-{{i}}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+        file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'),
+    )
+
+
+def remove_waiting_times(base_dir, year, token):
+    # Remove the files of the year written with append under token or a later one
+    year_dir = os.path.join(base_dir, f'year={year}')
+    if not os.path.isdir(year_dir):
+        return
+    for month_dir, _, file_names in os.walk(year_dir):
+        for file_name in file_names:
+            match = re.fullmatch(r'part-(\d{12})-\d+\.parquet', file_name)
+            if match and int(match.group(1)) >= token:
+                os.remove(os.path.join(month_dir, file_name))
+
+
+def read_waiting_times(base_dir, years=None, months=None, columns=None):
+    # Load records, opening only the year/month partitions asked for
+    dataset = ds.dataset(base_dir, format='parquet', partitioning=WAITING_TIME_PARTITIONING)
+    condition = None
+    if years is not None:
+        condition = ds.field('year').isin(list(years))
+    if months is not None:
+        month_condition = ds.field('month').isin(list(months))
+        condition = month_condition if condition is None else condition & month_condition
+    df = dataset.to_table(columns=columns, filter=condition).to_pandas()
+    if 'month' in df.columns:
+        df['month'] = pd.Categorical(df['month'], categories=MONTH_ORDER, ordered=True)
+    if 'first_job_gaps' in df.columns:
+        schemas = [fragment.physical_schema.metadata for fragment in dataset.get_fragments(filter=condition)]
+        df.attrs['first_job_gaps'] = common_gaps([stored_gaps(metadata) for metadata in schemas], f'records in {base_dir}')
+    return df
 
-    class_user_dict = dict(zip(queue_info['queuename'], queue_info['class_user']))
-    class_own_dict = dict(zip(queue_info['queuename'], queue_info['class_own']))
 
-    # Map class_user and class_own to the main DataFrame based on 'qname'
-    df['class_user'] = df['qname'].map(class_user_dict)
-    df['class_own'] = df['qname'].map(class_own_dict)
+# Dashboard data published by process_waiting_times.py: one zstd Parquet file per job_family=/year=/month=
+# partition (the partition values live in the path, not in the file) and an index of the partitions
+DASHBOARD_DIR = '/projectnb/rcs-intern/Jiazheng/accounting/dashboard'
+DASHBOARD_INDEX_FILE = '_index.json'
+# Aggregate cube published with the partitions: count, sum, min, max and a quantile sketch of the wait
+# per (year, month, day, job_family, job_type, class_user, class_own, slots_bucket)
+DASHBOARD_CUBE_FILE = '_cube.parquet'
+# Quantile sketch: waits in logarithmic buckets of relative width SKETCH_RELATIVE_ACCURACY, so any
+# quantile is within 1% of the true value, and sketches merge by adding the counts of equal buckets
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
 
+
+def dashboard_partition_path(base_dir, job_family, year, month):
+    return os.path.join(base_dir, f'job_family={job_family}', f'year={year}', f'month={month}', 'part-0.parquet')
+
+
+def read_dashboard_index(base_dir=DASHBOARD_DIR):
+    # job_family, year, month, path, rows and bytes of every published partition
+    with open(os.path.join(base_dir, DASHBOARD_INDEX_FILE)) as f:
+        return pd.DataFrame(json.load(f))
+
+
+def read_dashboard_month(job_family, year, month, base_dir=DASHBOARD_DIR, columns=None):
+    # One month of one job family, read from its single file; FileNotFoundError if it has no records
+    table = pq.read_table(dashboard_partition_path(base_dir, job_family, year, month), columns=columns)
+    df = table.to_pandas()
+    df.attrs['first_job_gaps'] = stored_gaps(table.schema.metadata)
+    df['year'] = np.int16(year)
+    df['month'] = pd.Categorical.from_codes(np.full(len(df), MONTH_ORDER.index(month)), categories=MONTH_ORDER, ordered=True)
     return df
+
+
+def read_aggregate_cube(base_dir=DASHBOARD_DIR, years=None, columns=None):
+    # Cube cells, only those of years when given; sketch_buckets / sketch_counts hold each cell's sketch
+    filters = [('year', 'in', list(years))] if years is not None else None
+    df = pq.read_table(os.path.join(base_dir, DASHBOARD_CUBE_FILE), columns=columns, filters=filters).to_pandas()
+    if 'month' in df.columns:
+        df['month'] = pd.Categorical(df['month'], categories=MONTH_ORDER, ordered=True)
+    return df
+
+
+def sketch_buckets(values):
+    # Sketch bucket of every wait: 0 for no wait, else 1 + ceil(log_gamma(wait))
+    values = np.asarray(values, dtype=np.float64)
+    buckets = np.zeros(len(values), dtype=np.uint16)
+    positive = values > 0
+    buckets[positive] = 1 + np.ceil(np.log(values[positive]) / np.log(SKETCH_GAMMA))
+    return buckets
+
+
+def sketch_quantile(buckets, counts, q):
+    # q-quantile of the merge of one or more sketches, each given as its bucket and count arrays
+    # (e.g. the sketch_buckets and sketch_counts of a selection of cube cells)
+    buckets = np.concatenate([np.asarray(b, dtype=np.int64) for b in buckets]) if len(buckets) else np.array([], dtype=np.int64)
+    counts = np.concatenate([np.asarray(c, dtype=np.int64) for c in counts]) if len(counts) else np.array([], dtype=np.int64)
+    cumulative = np.cumsum(np.bincount(buckets, weights=counts))
+    if not len(cumulative) or cumulative[-1] == 0:
+        return np.nan
+    bucket = np.searchsorted(cumulative, q * (cumulative[-1] - 1), side='right')
+    return 0.0 if bucket == 0 else 2 * SKETCH_GAMMA ** (bucket - 1) / (SKETCH_GAMMA + 1)
+
+
+# Per-queue queue depth every QUEUE_DEPTH_BIN_SECONDS: pending jobs and slots, running jobs and slots,
+# one zstd Parquet dataset hive-partitioned by year
+QUEUE_DEPTH_DIR = '/projectnb/rcs-intern/Jiazheng/accounting/queue_depth'
+QUEUE_DEPTH_BIN_SECONDS = 300
+QUEUE_DEPTH_TYPES = {
+    'qname': 'category',
+    'pending': 'uint32',
+    'pending_slots': 'uint32',
+    'running': 'uint32',
+    'running_slots': 'uint32',
+}
+QUEUE_DEPTH_PARTITIONING = ds.partitioning(pa.schema([('year', pa.int16())]), flavor='hive')
+
+
+def write_queue_depth(df, base_dir, year):
+    # Replace the year's partition of the queue-depth dataset
+    year_dir = os.path.join(base_dir, f'year={year}')
+    if os.path.isdir(year_dir):
+        shutil.rmtree(year_dir)
+    if df.empty:
+        return
+    ds.write_dataset(
+        pa.Table.from_pandas(df.astype(QUEUE_DEPTH_TYPES).assign(year=year), preserve_index=False),
+        base_dir,
+        format='parquet',
+        partitioning=QUEUE_DEPTH_PARTITIONING,
+        basename_template='part-{i}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+        file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'),
+    )
+
+
+def read_queue_depth(base_dir, years=None, queues=None, columns=None):
+    # Load the series, opening only the years asked for
+    dataset = ds.dataset(base_dir, format='parquet', partitioning=QUEUE_DEPTH_PARTITIONING)
+    condition = None
+    if years is not None:
+        condition = ds.field('year').isin(list(years))
+    if queues is not None:
+        queue_condition = ds.field('qname').isin(list(queues))
+        condition = queue_condition if condition is None else condition & queue_condition
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+# Arrow types the yearly CSVs are parsed with, matching WAITING_TIME_TYPES: labels as dictionaries
+# (pandas categoricals), seconds and calendar fields as the narrow integer types
+WAITING_TIME_CSV_TYPES = {
+    column: pa.dictionary(pa.int32(), pa.string()) if dtype == 'category' or isinstance(dtype, pd.CategoricalDtype)
+    else pa.from_numpy_dtype(np.dtype(dtype))
+    for column, dtype in WAITING_TIME_TYPES.items()
+}
+
+
+def read_waiting_times_csv(file_name, min_wait=0):
+    # One yearly CSV parsed by Arrow's multithreaded reader straight into the compact types, dropping
+    # records with a negative or missing wait, year or job type before anything is converted to pandas.
+    # Integer columns with missing values (years written before a column existed) still come back as
+    # floats and get their nullable type from compact_waiting_times.
+    table = pa_csv.read_csv(
+        file_name,
+        read_options=pa_csv.ReadOptions(use_threads=True),
+        convert_options=pa_csv.ConvertOptions(column_types=WAITING_TIME_CSV_TYPES, strings_can_be_null=True),
+    )
+    wait = ds.field('first_job_waiting_time')
+    table = table.filter(wait.is_valid() & (wait >= min_wait) & ds.field('year').is_valid() & ds.field('job_type').is_valid())
+    df = table.to_pandas()
+    if 'month' in df.columns:
+        # only the 12 dictionary entries are re-mapped, not the rows
+        df['month'] = df['month'].cat.set_categories(MONTH_ORDER, ordered=True)
+    return compact_waiting_times(df)
+
+
+class RunLog:
+    # Stage-level instrumentation: wall time, rows in/out, rows/sec and memory of every stage,
+    # appended as JSON lines to path (when set) with the run's context on every line. Memory is
+    # the RSS when the stage starts and ends, the stage's own peak RSS (peak_rss_mb, None where the
+    # high-water mark cannot be reset), and the process-wide peaks so far of this process and its children.
+    def __init__(self, path=None, **context):
+        self.path = path
+        self.context = context
+        self.records = []
+        self.open_peaks = []
+        self.process_peak_mb = 0.0  # resetting the high-water mark also resets ru_maxrss, so the highest peak is kept here
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None):
+        # Set record['rows_out'] inside the block when the stage changes the row count
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': rows_in}
+        rss_start_mb = current_rss_mb()
+        peak = self.enter_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            rows = record['rows_in'] if record['rows_in'] is not None else record['rows_out']
+            stage_peak_mb = self.exit_peak(peak)
+            self.process_peak_mb = max(self.process_peak_mb, stage_peak_mb or 0,
+                                       resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)  # KiB on Linux
+            record.update({
+                'seconds': round(seconds, 6),
+                'rows_per_sec': round(rows / seconds) if rows is not None and seconds > 0 else None,
+                'rss_start_mb': rss_start_mb,
+                'rss_mb': current_rss_mb(),
+                'peak_rss_mb': stage_peak_mb,
+                'process_peak_rss_mb': self.process_peak_mb,
+                'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+            })
+            self.write(record)
+
+    def enter_peak(self):
+        # Start tracking a stage's peak: the high-water mark so far is credited to the stages already
+        # open (it was reached inside them) before it is reset for the new stage
+        high_water_mb = reset_peak_rss_mb()
+        self.process_peak_mb = max(self.process_peak_mb, high_water_mb or 0)
+        for open_peak in self.open_peaks:
+            open_peak['mb'] = None if high_water_mb is None or open_peak['mb'] is None else max(open_peak['mb'], high_water_mb)
+        peak = {'mb': None if high_water_mb is None else 0.0}
+        self.open_peaks.append(peak)
+        return peak
+
+    def exit_peak(self, peak):
+        # The stage's peak: the highest of the high-water mark now and the ones taken when its inner stages started
+        self.open_peaks.remove(peak)
+        if peak['mb'] is None:
+            return None
+        return max(peak['mb'], peak_rss_mb() or 0)
+
+    def write(self, record):
+        record = {**self.context, 'time': datetime.datetime.now().isoformat(timespec='seconds'), **record}
+        self.records.append(record)
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+
+def current_rss_mb():
+    # Resident set size of this process right now (Linux)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return None
+
+
+def peak_rss_mb():
+    # High-water mark of this process's RSS since it started or was last reset (VmHWM, Linux)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss_mb():
+    # Return the high-water mark, then reset it to the current RSS (Linux 4.0+), so the next
+    # peak_rss_mb reading is the peak of what runs from here. None where it cannot be reset.
+    peak = peak_rss_mb()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return None
+    return peak
+
+
+run_log = RunLog()
+
+
+def start_run_log(path=None, **context):
+    # Make a new RunLog the one that stage() records into for the rest of this process's run
+    global run_log
+    run_log = RunLog(path, **context)
+    return run_log
+
+
+def stage(name, rows_in=None):
+    return run_log.stage(name, rows_in)
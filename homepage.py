@@ -27,15 +27,11 @@ dataset["job_type"] = dataset["job_type"].apply(
 # Handle empty strings
 dataset["job_type"] = dataset["job_type"].replace("", pd.NA)
 
-# Ensure 'year' is integer
-dataset["year"] = dataset["year"].astype(int)
-
-# Define month ordering
+# 'year' (int16) and 'month' (ordered categorical) are stored typed by process_waiting_times.py
 month_order = [
     "Jan", "Feb", "Mar", "Apr", "May", "Jun",
     "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"
 ]
-dataset["month"] = pd.Categorical(dataset["month"], categories=month_order, ordered=True)
 
 # Pre-define icons
 ICONS = {
@@ -368,7 +364,7 @@ def homepage_server(input, output, session, selected_year, selected_month):
 
         # Compute medians
         medians = (
-            df.groupby("job_type")["first_job_waiting_time"]
+            df.groupby("job_type", observed=True)["first_job_waiting_time"]
             .median()
             .reset_index()
         )
@@ -10,18 +10,11 @@ import datetime
 now = datetime.datetime.now()
 dataset = pd.read_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_MPI.feather")
 
-# Ensure 'year' is integer
-dataset["year"] = dataset["year"].astype(int)
-
+# 'year' (int16) and 'month' (ordered categorical) are stored typed by process_waiting_times.py
 month_order = [
     "Jan", "Feb", "Mar", "Apr", "May", "Jun",
     "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"
 ]
-dataset["month"] = pd.Categorical(
-    dataset["month"], 
-    categories=month_order, 
-    ordered=True
-)
 
 ICONS = {
     "min": fa.icon_svg("arrow-down"),
@@ -291,7 +284,7 @@ def mpi_job_server(input, output, session, selected_year, selected_month):
         df_plot = df_plot[df_plot["first_job_waiting_time"] >= 0]
 
         # Compute median waiting time per job_type
-        medians = df_plot.groupby("job_type")["first_job_waiting_time"].median().reset_index()
+        medians = df_plot.groupby("job_type", observed=True)["first_job_waiting_time"].median().reset_index()
 
         # Get top 6 job_types with largest medians
         top6 = medians.nlargest(6, "first_job_waiting_time")["job_type"].tolist()
@@ -301,7 +294,7 @@ def mpi_job_server(input, output, session, selected_year, selected_month):
 
         # Recalculate median on grouped data
         grouped = (
-            df_plot.groupby("job_type_grouped")["first_job_waiting_time"]
+            df_plot.groupby("job_type_grouped", observed=True)["first_job_waiting_time"]
             .median()
             .reset_index()
             .sort_values("first_job_waiting_time", ascending=True)
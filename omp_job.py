@@ -12,22 +12,15 @@ import datetime
 dataset = pd.read_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_OMP.feather")
 now = datetime.datetime.now()
 
-# Drop rows with any NaN values (if desired, specify subset= for selective dropping)
-dataset.dropna(inplace=True)
+# Drop rows with NaN in the columns this page uses only: hour/weekday are missing for years written before they existed,
+# and columns such as the GPU request fields are missing for every non-GPU job
+dataset.dropna(subset=["job_type", "class_user", "class_own", "first_job_waiting_time", "year", "month", "day", "slots"], inplace=True)
 
-# Convert 'year' column to integer type
-dataset['year'] = dataset['year'].astype(int)
-
-# Set the month column to a categorical with a fixed order
+# 'year' (int16) and 'month' (ordered categorical) are stored typed by process_waiting_times.py
 month_order = [
     "Jan", "Feb", "Mar", "Apr", "May", "Jun",
     "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"
 ]
-dataset["month"] = pd.Categorical(
-    dataset["month"], 
-    categories=month_order, 
-    ordered=True
-)
 
 # Identify the CPU cores (slots) used by OMP jobs
 cpus = sorted(dataset[dataset.job_type == 'omp'].slots.unique().tolist())
@@ -360,7 +353,7 @@ def omp_job_server(input, output, session, selected_year, selected_month):
         df_plot["waiting_time_min"] = df_plot["first_job_waiting_time"] / 60
 
         # Compute median waiting time per job_type
-        medians = df_plot.groupby("job_type")["waiting_time_min"].median().reset_index()
+        medians = df_plot.groupby("job_type", observed=True)["waiting_time_min"].median().reset_index()
 
         # Identify top 6 job types with highest median
         top6 = medians.nlargest(6, "waiting_time_min")["job_type"].tolist()
@@ -370,7 +363,7 @@ def omp_job_server(input, output, session, selected_year, selected_month):
 
         # Recalculate medians with grouped data
         grouped = (
-            df_plot.groupby("job_type_grouped")["waiting_time_min"]
+            df_plot.groupby("job_type_grouped", observed=True)["waiting_time_min"]
             .median()
             .reset_index()
             .sort_values(by="waiting_time_min", ascending=True)
@@ -10,17 +10,15 @@ import datetime
 dataset = pd.read_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_OneP.feather")
 now = datetime.datetime.now()
 
-# Ensure 'year' is integer
-# Optional: Remove rows with NaN values if needed
-dataset.dropna(inplace=True)
-dataset['year'] = dataset['year'].astype(int)
+# Drop rows with NaN in the columns this page uses only: hour/weekday are missing for years written before they existed,
+# and columns such as the GPU request fields are missing for every non-GPU job
+dataset.dropna(subset=["job_type", "class_user", "class_own", "first_job_waiting_time", "year", "month", "day", "slots"], inplace=True)
 
-# Set month order
+# 'year' (int16) and 'month' (ordered categorical) are stored typed by process_waiting_times.py
 month_order = [
     "Jan", "Feb", "Mar", "Apr", "May", "Jun",
     "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"
 ]
-dataset['month'] = pd.Categorical(dataset['month'], categories=month_order, ordered=True)
 
 # ICONS
 ICONS = {
@@ -250,7 +248,7 @@ def oneP_job_server(input, output, session, selected_year, selected_month):
         df_plot["waiting_time_min"] = df_plot["first_job_waiting_time"] / 60
 
         # Compute median waiting time per job_type
-        medians = df_plot.groupby("job_type")["waiting_time_min"].median().reset_index()
+        medians = df_plot.groupby("job_type", observed=True)["waiting_time_min"].median().reset_index()
 
         # Identify top 6 job types with highest median
         top6 = medians.nlargest(6, "waiting_time_min")["job_type"].tolist()
@@ -260,7 +258,7 @@ def oneP_job_server(input, output, session, selected_year, selected_month):
 
         # Recalculate medians with grouped data
         grouped = (
-            df_plot.groupby("job_type_grouped")["waiting_time_min"]
+            df_plot.groupby("job_type_grouped", observed=True)["waiting_time_min"]
             .median()
             .reset_index()
             .sort_values(by="waiting_time_min", ascending=True)
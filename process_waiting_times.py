@@ -1,79 +1,353 @@
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import shutil
 from datetime import datetime
-import os  
-import time  
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pandas.api.types import union_categoricals
+from helpers import (read_waiting_times, read_waiting_times_csv, compact_waiting_times, dashboard_partition_path, sketch_buckets,
+                     common_gaps, gaps_metadata, FIRST_JOB_GAPS, WAITING_TIMES_DIR, DASHBOARD_DIR, DASHBOARD_INDEX_FILE,
+                     DASHBOARD_CUBE_FILE, MONTH_ORDER)
 
-# Start the timer
-start_time = time.time()
+ACCOUNTING_DIR = "/projectnb/rcs-intern/Jiazheng/accounting"
+FIRST_YEAR = 2013
+# Cleaned per-year Feather fragments and the manifest of the inputs they were built from,
+# kept under the accounting directory
+FRAGMENT_DIR = "consolidated_years"
+MANIFEST_FILE = "manifest.json"
+# Years parsed at once; Arrow also parses each CSV with its own threads
+LOAD_THREADS = 4
+# Dashboard subsets: job_type label prefix -> ShinyApp_Data_<name>
+JOB_FAMILIES = {"GPU": "GPU", "MPI": "MPI", "OMP": "OMP", "1-p": "OneP"}
+# GPU request fields: missing for every other job, so left out of the other families' files
+GPU_COLUMNS = ["gpus", "gpu_c", "gpu_memory_gb"]
+# Dimensions of the aggregate cube, and the slot ranges of its slots_bucket (lower bounds)
+CUBE_KEYS = ["year", "month", "day", "job_family", "job_type", "class_user", "class_own", "slots_bucket"]
+SLOTS_BUCKETS = [1, 2, 5, 9, 17, 29, 65]
+SLOTS_BUCKET_LABELS = ["1", "2-4", "5-8", "9-16", "17-28", "29-64", "65+"]
 
 current_year = datetime.now().year
 
-dataframes = []
-# Automatically process all year CSV files into feather format
-for year in range(2013, current_year + 1):
-    file_path = f"/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_per_job_type.csv"
+
+def year_source(year, accounting_dir=ACCOUNTING_DIR, waiting_times_dir=WAITING_TIMES_DIR):
+    # The partitioned Parquet output of GetQueueTime.py when the year has one, else the year's CSV (None if neither)
+    year_dir = os.path.join(waiting_times_dir, f"year={year}")
+    if os.path.isdir(year_dir):
+        return year_dir
+    file_path = f"{accounting_dir}/waiting_times_{year}_per_job_type.csv"
     if os.path.exists(file_path):
-        df = pd.read_csv(file_path)
-        dataframes.append(df)
+        return file_path
+    return None
+
+
+def source_files(path):
+    # Every file of a source, a single CSV or a partition directory, in a stable order
+    if os.path.isfile(path):
+        return [path]
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+
+
+def source_stat(path):
+    # Total size and latest mtime of a source: cheap, checked before hashing
+    stats = [os.stat(file_name) for file_name in source_files(path)]
+    return {'size': sum(stat.st_size for stat in stats), 'mtime': max((stat.st_mtime for stat in stats), default=0)}
+
+
+def source_hash(path):
+    digest = hashlib.sha256()
+    for file_name in source_files(path):
+        digest.update(os.path.relpath(file_name, path).encode())
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(fragment_dir):
+    manifest_path = os.path.join(fragment_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_manifest(fragment_dir, manifest):
+    # Written to a temporary file first so an interrupted run never leaves a torn manifest
+    manifest_path = os.path.join(fragment_dir, MANIFEST_FILE)
+    with open(f"{manifest_path}.tmp", 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def parse_year(source, year):
+    # Read one year's records and clean them once, so a fragment loads as is. A CSV is parsed
+    # straight into the compact types, dropping negative and missing waits while parsing.
+    if not os.path.isdir(source):
+        return read_waiting_times_csv(source)
+    df = read_waiting_times(os.path.dirname(source), years=[year])
+
+    # Remove 'buyin' rows
+    # df = df[df["queue_type"] != "buyin"].reset_index(drop=True)
+
+    # Drop rows with NA if needed
+    df = df[df["first_job_waiting_time"] >= 0] # drop negative value in case!
+    df = df.dropna(subset=["year", "job_type", "first_job_waiting_time"])
+    return compact_waiting_times(df).reset_index(drop=True)
+
+
+def load_year(year, source, fragment_dir, manifest, rebuild=False):
+    # The year's cleaned records: the fragment built earlier when the manifest shows its source
+    # unchanged (same size and mtime, or else same content hash), otherwise parsed again. The
+    # first_job_gaps thresholds of a Parquet source are kept in the manifest (a CSV cannot record them).
+    fragment_path = os.path.join(fragment_dir, f"waiting_times_{year}.feather")
+    entry = manifest.get(str(year))
+    stat = source_stat(source)
+    if not rebuild and entry is not None and entry['source'] == source and os.path.exists(fragment_path):
+        if entry['size'] == stat['size'] and entry['mtime'] == stat['mtime']:
+            return read_fragment(fragment_path, entry), 'reused'
+        digest = source_hash(source)
+        if entry['sha256'] == digest:
+            manifest[str(year)] = {**entry, **stat}
+            return read_fragment(fragment_path, entry), 'reused (touched)'
     else:
-        print(f"File not found: {file_path}")
+        digest = source_hash(source)
+
+    df = parse_year(source, year)
+    df.to_feather(fragment_path)
+    manifest[str(year)] = {'source': source, **stat, 'sha256': digest, 'gaps': df.attrs.get('first_job_gaps', FIRST_JOB_GAPS)}
+    return df, 'parsed'
+
+
+def read_fragment(fragment_path, entry):
+    df = pd.read_feather(fragment_path)
+    df.attrs['first_job_gaps'] = entry.get('gaps', FIRST_JOB_GAPS)
+    return df
+
+
+def unify_categories(dataframes):
+    # Give every categorical column the same categories in each year, so pd.concat keeps it categorical
+    # instead of falling back to object. Where years differ they get the union, sorted unless the column
+    # is ordered (like month). Only the categories are combined, not the values.
+    columns = {column for df in dataframes for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)}
+    for column in columns:
+        typed = [df for df in dataframes if column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype)]
+        if all(df[column].dtype == typed[0][column].dtype for df in typed):
+            continue
+        ordered = typed[0][column].cat.ordered
+        categories = union_categoricals([pd.Categorical([], categories=df[column].cat.categories, ordered=ordered) for df in typed],
+                                        sort_categories=not ordered).categories
+        for df in typed:
+            df[column] = df[column].cat.set_categories(categories)
 
-dataset = pd.concat(dataframes, ignore_index=True)
 
-# Remove 'buyin' rows
-# dataset = dataset[dataset["queue_type"] != "buyin"].reset_index(drop=True)
+def load_dataset(years=None, accounting_dir=ACCOUNTING_DIR, waiting_times_dir=WAITING_TIMES_DIR, rebuild=False,
+                 threads=LOAD_THREADS):
+    years = years or range(FIRST_YEAR, current_year + 1)
+    fragment_dir = os.path.join(accounting_dir, FRAGMENT_DIR)
+    os.makedirs(fragment_dir, exist_ok=True)
+    manifest = read_manifest(fragment_dir)
 
-# Basic cleaning/conversions here so we don’t do them repeatedly:
-dataset["year"] = dataset["year"].astype(int, errors="ignore")
+    sources = {}
+    for year in years:
+        source = year_source(year, accounting_dir, waiting_times_dir)
+        if source is None:
+            print(f"File not found: {accounting_dir}/waiting_times_{year}_per_job_type.csv")
+            manifest.pop(str(year), None)
+        else:
+            sources[year] = source
 
-month_order = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", 
-               "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
-if "month" in dataset.columns:
-    dataset["month"] = pd.Categorical(dataset["month"], categories=month_order, ordered=True)
+    # Automatically process all years into feather format, re-parsing only the years whose input changed,
+    # several years at a time (each thread updates only its own year's manifest entry)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        loaded = list(pool.map(lambda year: load_year(year, sources[year], fragment_dir, manifest, rebuild), sources))
+    dataframes = []
+    for (year, source), (df, status) in zip(sources.items(), loaded):
+        print(f"{year}: {status} ({len(df)} rows from {source})")
+        dataframes.append(df)
+    write_manifest(fragment_dir, manifest)
+
+    # Bits of different first_job_gaps thresholds cannot share a column
+    gaps = common_gaps([df.attrs.get('first_job_gaps', FIRST_JOB_GAPS) for df in dataframes], f'years {list(sources)}')
+    unify_categories(dataframes)
+    dataset = pd.concat(dataframes, ignore_index=True)
 
-# Drop rows with NA if needed
-dataset = dataset[dataset["first_job_waiting_time"] >= 0] # drop negative value in case!
-dataset.dropna(subset=["year", "job_type", "first_job_waiting_time"], inplace=True)
+    # The compact schema is stored with the files, so the app pages load it as is; after unify_categories
+    # this only casts the columns some years lack (missing values there)
+    dataset = compact_waiting_times(dataset)
+    dataset.attrs['first_job_gaps'] = gaps
+    return dataset
 
-# Define filter functions
-def filter_data_by_job_type(job_type_pattern, years=None):
-    """Generic function to filter dataset by job type and years."""
-    df = dataset[dataset["job_type"].str.startswith(job_type_pattern, na=False)].copy()
+def job_family_codes(dataset, years=None):
+    # Position in JOB_FAMILIES of every record's job_type (-1 for none, or outside years), decided
+    # once per distinct label and broadcast through the categorical codes
+    labels = dataset["job_type"].astype("category")
+    categories = labels.cat.categories.astype(str)
+    family_of_label = np.full(len(categories) + 1, -1)  # the last entry is for a missing label (code -1)
+    for family, prefix in enumerate(JOB_FAMILIES):
+        family_of_label[:-1][(family_of_label[:-1] < 0) & categories.str.startswith(prefix)] = family
+    codes = family_of_label[labels.cat.codes.to_numpy()]
     if years:
-        df = df[df["year"].isin(years)]
-    return df
+        codes[~dataset["year"].isin(years).to_numpy()] = -1
+    return codes
+
+
+def split_by_job_family(dataset, years=None):
+    # Row positions of each family in one pass: a stable sort of the family codes keeps every
+    # subset in dataset order
+    codes = job_family_codes(dataset, years)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(-1, len(JOB_FAMILIES) + 1))
+    return {name: order[bounds[family + 1]:bounds[family + 2]] for family, name in enumerate(JOB_FAMILIES.values())}
+
+
+def write_subset(table, dataset, rows, output_path, csv=False, drop_columns=()):
+    # rows None is the whole dataset
+    drop_columns = [column for column in drop_columns if column in dataset.columns]
+    subset = (table if rows is None else table.take(rows)).drop_columns(drop_columns)
+    feather.write_feather(subset, f"{output_path}.feather")
+    if csv:
+        (dataset if rows is None else dataset.iloc[rows]).drop(columns=drop_columns).to_csv(f"{output_path}.csv", index=False)
+
 
-# Save each filtered dataset as a Feather and CSV file
-def save_filtered_data():
-    years = list(range(2013, current_year + 1))  
+# Save each job family's records and the fully cleaned dataset as Feather files (and CSV with csv=True)
+def save_filtered_data(dataset, output_dir=ACCOUNTING_DIR, csv=False):
+    years = list(range(FIRST_YEAR, current_year + 1))
 
-    # GPU jobs
-    gpu_df = filter_data_by_job_type("GPU", years)
-    gpu_df.reset_index(drop=True).to_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_GPU.feather")
-    gpu_df.to_csv("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_GPU.csv", index=False)
+    # Convert to Arrow once; every subset is a take of the same table, and the five files are
+    # written concurrently (Arrow releases the GIL while it writes)
+    table = pa.Table.from_pandas(dataset, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, **gaps_metadata(dataset.attrs.get('first_job_gaps', FIRST_JOB_GAPS))})
+    outputs = {f"{output_dir}/ShinyApp_Data_{name}": (rows, () if name == "GPU" else GPU_COLUMNS)
+               for name, rows in split_by_job_family(dataset, years).items()}
+    outputs[f"{output_dir}/ShinyApp_Data"] = (None, ())
+    with ThreadPoolExecutor(max_workers=len(outputs)) as pool:
+        futures = [pool.submit(write_subset, table, dataset, rows, path, csv, drop_columns) for path, (rows, drop_columns) in outputs.items()]
+        for future in futures:
+            future.result()
 
-    # MPI jobs
-    mpi_df = filter_data_by_job_type("MPI", years)
-    mpi_df.reset_index(drop=True).to_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_MPI.feather")
-    mpi_df.to_csv("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_MPI.csv", index=False)
+def aggregate_cube(dataset, family):
+    # One row per cube cell with the count, sum, min and max of the waits and their sketch as two
+    # list columns (sketch_buckets, sketch_counts); family is job_family_codes(dataset)
+    rows = family >= 0
+    df = dataset.loc[rows, ["year", "month", "day", "job_type", "class_user", "class_own"]]
+    df["job_family"] = pd.Categorical.from_codes(family[rows], categories=list(JOB_FAMILIES.values()))
+    slots = dataset.loc[rows, "slots"].fillna(0).to_numpy(dtype=np.int64)
+    df["slots_bucket"] = pd.Categorical.from_codes(np.searchsorted(SLOTS_BUCKETS, slots, side="right") - 1,
+                                                   categories=SLOTS_BUCKET_LABELS, ordered=True)
+    wait = dataset.loc[rows, "first_job_waiting_time"].to_numpy(dtype=np.int64)
 
-    # OMP jobs
-    omp_df = filter_data_by_job_type("OMP", years)
-    omp_df.reset_index(drop=True).to_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_OMP.feather")
-    omp_df.to_csv("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_OMP.csv", index=False)
+    cell = df.groupby(CUBE_KEYS, observed=True, dropna=False).ngroup().to_numpy()
+    cells, first_row = np.unique(cell, return_index=True)
+    by_cell = pd.Series(wait).groupby(cell)
+    cube = df.iloc[first_row][CUBE_KEYS].reset_index(drop=True)
+    cube["count"] = np.bincount(cell, minlength=len(cells)).astype(np.uint32)
+    cube["sum"] = by_cell.sum().to_numpy()
+    cube["min"] = by_cell.min().to_numpy().astype(np.int32)
+    cube["max"] = by_cell.max().to_numpy().astype(np.int32)
 
-    # 1-p jobs
-    onep_df = filter_data_by_job_type("1-p", years)
-    onep_df.reset_index(drop=True).to_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_OneP.feather")
-    onep_df.to_csv("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_OneP.csv", index=False)
+    # Sketches: (cell, bucket) pairs counted in one sort, then cut into one list per cell
+    pairs, pair_counts = np.unique(cell.astype(np.int64) << 16 | sketch_buckets(wait), return_counts=True)
+    offsets = np.searchsorted(pairs >> 16, np.arange(len(cells) + 1)).astype(np.int32)
+    table = pa.Table.from_pandas(cube, preserve_index=False)
+    table = table.append_column("sketch_buckets", pa.ListArray.from_arrays(offsets, pa.array((pairs & 0xFFFF).astype(np.uint16))))
+    return table.append_column("sketch_counts", pa.ListArray.from_arrays(offsets, pa.array(pair_counts.astype(np.uint32))))
 
-    # Save the fully cleaned dataset
-    dataset.reset_index(drop=True).to_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data.feather")
-    dataset.to_csv("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data.csv", index=False)
+
+def write_partition(table, rows, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table.take(rows), path, compression="zstd")
+    return os.path.getsize(path)
+
+
+def publish_version(output_dir, version_dir):
+    # output_dir is a symlink to the current version directory ({output_dir}.<timestamp>), replaced in
+    # one rename, so readers see the old or the new dataset and never none or half of one. The version
+    # it replaced is kept for readers still on it; older versions and the leftovers of crashed runs
+    # (including the .tmp/.old directories of the earlier swap) are removed.
+    if os.path.isdir(output_dir) and not os.path.islink(output_dir):
+        # a dataset published before versioning becomes a version itself (the only time readers see none)
+        os.replace(output_dir, f"{output_dir}.legacy")
+    previous = os.path.realpath(output_dir) if os.path.islink(output_dir) else os.path.realpath(f"{output_dir}.legacy")
+    link = f"{output_dir}.link"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(version_dir), link)
+    os.replace(link, output_dir)
+
+    keep = {os.path.realpath(version_dir), previous}
+    parent, name = os.path.split(os.path.abspath(output_dir))
+    for entry in os.listdir(parent):
+        path = os.path.join(parent, entry)
+        if (re.fullmatch(re.escape(name) + r"\.(\d{8}T\d{12}|tmp|old|legacy)", entry) and os.path.isdir(path)
+                and not os.path.islink(path) and os.path.realpath(path) not in keep):
+            shutil.rmtree(path)
+
+
+# Publish the job_family=/year=/month= partitioned dashboard dataset, its index and the aggregate cube
+def publish_dashboard_dataset(dataset, output_dir=DASHBOARD_DIR, threads=LOAD_THREADS):
+    years = list(range(FIRST_YEAR, current_year + 1))
+
+    # One stable sort on (family, year, month) gives every partition's rows, in dataset order
+    family = job_family_codes(dataset, years)
+    year = dataset["year"].to_numpy(dtype=np.int64)
+    month = pd.Categorical(dataset["month"], categories=MONTH_ORDER).codes.astype(np.int64)
+    key = (family * 10000 + year) * 12 + month
+    key[(family < 0) | (month < 0)] = -1
+    order = np.argsort(key, kind="stable")
+    order = order[key[order] >= 0]
+    starts = np.flatnonzero(np.r_[True, np.diff(key[order]) != 0]) if len(order) else np.array([], dtype=np.int64)
+    bounds = np.r_[starts, len(order)]
+
+    # The partition values are in the paths, so the files hold the other columns only. Everything is
+    # written to a new version directory first and swapped in at the end (see publish_version).
+    table = pa.Table.from_pandas(dataset.drop(columns=["year", "month"]), preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, **gaps_metadata(dataset.attrs.get('first_job_gaps', FIRST_JOB_GAPS))})
+    staging_dir = f"{output_dir}.{datetime.now():%Y%m%dT%H%M%S%f}"
+    families = list(JOB_FAMILIES.values())
+    index = []
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            partition_key = key[order[start]]
+            entry = {"job_family": families[partition_key // 12 // 10000], "year": int(partition_key // 12 % 10000),
+                     "month": MONTH_ORDER[partition_key % 12], "rows": int(stop - start)}
+            path = dashboard_partition_path(staging_dir, entry["job_family"], entry["year"], entry["month"])
+            entry["path"] = os.path.relpath(path, staging_dir)
+            futures.append(pool.submit(write_partition, table, order[start:stop], path))
+            index.append(entry)
+        # the cube is built while the partitions are being written
+        os.makedirs(staging_dir, exist_ok=True)
+        cube = aggregate_cube(dataset, family)
+        pq.write_table(cube, os.path.join(staging_dir, DASHBOARD_CUBE_FILE), compression="zstd")
+        for entry, future in zip(index, futures):
+            entry["bytes"] = future.result()
+    with open(os.path.join(staging_dir, DASHBOARD_INDEX_FILE), "w") as f:
+        json.dump(index, f, indent=1)
+
+    publish_version(output_dir, staging_dir)
+    print(f"Dashboard dataset: {len(index)} partitions and {cube.num_rows} cube cells saved to {output_dir}")
+    return index
 
 # Usage
 if __name__ == "__main__":
-    save_filtered_data()
+    parser = argparse.ArgumentParser(description='Consolidate the yearly waiting times for the Shiny app.')
+    parser.add_argument('--rebuild', action='store_true', help='Re-parse every year, ignoring the manifest')
+    parser.add_argument('--csv', action='store_true', help='Also write every output as CSV')
+    args = parser.parse_args()
+
+    # Start the timer
+    start_time = time.time()
+    dataset = load_dataset(rebuild=args.rebuild)
+    save_filtered_data(dataset, csv=args.csv)
+    publish_dashboard_dataset(dataset)
     # Calculate elapsed time
     elapsed_time = time.time() - start_time
-    print(f"All files have been successfully output in {elapsed_time:.2f} seconds.")
\ No newline at end of file
+    print(f"All files have been successfully output in {elapsed_time:.2f} seconds.")
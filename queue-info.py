@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 import sys
 import pandas as pd
-from pathlib import Path
+from helpers import read_dashboard_month
 
 # Helper function to format time
 def format_time(seconds):
@@ -20,8 +20,7 @@ if len(sys.argv) != 3:
 year = int(sys.argv[1])
 month = int(sys.argv[2])
 
-# Define the path to the Feather files
-base_path = Path("/projectnb/rcs-intern/Jiazheng/accounting")
+# The month of each job type is one file of the partitioned dashboard dataset
 job_types = ["GPU", "MPI", "OMP", "OneP"]
 
 # Map month number to month abbreviation (e.g., 4 -> "Apr")
@@ -38,17 +37,11 @@ print("-" * 95)
 
 # Process each job type
 for job_type in job_types:
-    file_path = base_path / f"ShinyApp_Data_{job_type}.feather"
-    
-    # Read the Feather file
+    # Read only the year and month asked for; a month without records has no file
     try:
-        df = pd.read_feather(file_path)
+        filtered_df = read_dashboard_month(job_type, year, month_name, columns=["first_job_waiting_time"])
     except FileNotFoundError:
-        print(f"File not found: {file_path}")
-        continue
-
-    # Filter rows by year and month
-    filtered_df = df[(df["year"] == year) & (df["month"] == month_name)]
+        filtered_df = pd.DataFrame()
 
     # Calculate statistics
     if not filtered_df.empty: